@@ -0,0 +1,100 @@
+# FILE: bench_db.py
+"""
+Đo tốc độ ghi trạng thái thiết bị (db_manager.update_device_state) trên DB tạm.
+
+Usage:
+    python bench_db.py                       # 200 thiết bị, 5000 lần ghi
+    python bench_db.py --devices 500 --updates 20000 --threads 8
+    python bench_db.py --requests 2000       # Request Flask (mỗi request 1 luồng mới như werkzeug)
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import db_manager
+
+def setup(path, devices):
+    db_manager.DB_FILE = path
+    db_manager.init_db()
+    for i in range(devices):
+        db_manager.upsert_device({'id': f"bench{i:05d}", 'name': f"Bench {i}", 'ip': '10.0.0.1',
+                                  'key': '0123456789abcdef', 'dps': {"1": False, "2": 0}})
+
+def writer(devices, count, results):
+    for n in range(count):
+        dev_id = f"bench{random.randrange(devices):05d}"
+        db_manager.update_device_state(dev_id, {"1": n % 2 == 0, "2": n})
+    results.append(count)
+
+def reader(stop, latencies):
+    while not stop.is_set():
+        t = time.perf_counter()
+        db_manager.get_all_devices()
+        latencies.append(time.perf_counter() - t)
+        time.sleep(0.01)
+
+def run(devices, updates, threads):
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_db_'), 'bench.db')
+    setup(path, devices)
+
+    # Song song với 1 luồng đọc (giả lập UI/MCP đọc DB trong lúc poll ghi)
+    stop = threading.Event()
+    latencies = []
+    rd = threading.Thread(target=reader, args=(stop, latencies), daemon=True)
+    rd.start()
+
+    done = []
+    per_thread = updates // threads
+    workers = [threading.Thread(target=writer, args=(devices, per_thread, done)) for _ in range(threads)]
+    t = time.perf_counter()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    db_manager.flush_device_states()  # Tính cả thời gian ghi xuống đĩa phần còn chờ
+    elapsed = time.perf_counter() - t
+    stop.set()
+    rd.join()
+
+    total = sum(done)
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    print(f"update_device_state: {total} writes / {threads} threads in {elapsed:.2f}s -> {total / elapsed:.0f} writes/s")
+    print(f"get_all_devices while writing: {len(latencies)} reads, p50 {p50:.1f}ms, p99 {p99:.1f}ms")
+
+def bench_requests(devices, requests):
+    """Độ trễ request đọc DB qua Flask test client, mỗi request chạy trong 1 luồng mới (như werkzeug threaded)."""
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_db_'), 'bench.db')
+    setup(path, devices)
+    os.environ['WERKZEUG_RUN_MAIN'] = 'true'   # Không chạy luồng poll/timer của main
+    import main
+    client = main.app.test_client()
+    now = time.time()
+
+    urls = ['/api/settings', f'/api/history?id=bench00000&dp=2&start={now - 3600}&end={now}']
+    latencies = []
+    def one(url):
+        t = time.perf_counter()
+        client.get(url)
+        latencies.append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    for n in range(requests):
+        th = threading.Thread(target=one, args=(urls[n % len(urls)],))
+        th.start()
+        th.join()
+    elapsed = time.perf_counter() - t
+    latencies.sort()
+    print(f"Flask requests (1 thread each): {requests} in {elapsed:.2f}s, p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark db_manager writes")
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=0, help="Đo request Flask thay vì ghi trạng thái")
+    args = parser.parse_args()
+    if args.requests: bench_requests(args.devices, args.requests)
+    else: run(args.devices, args.updates, args.threads)
@@ -1,12 +1,98 @@
 import sqlite3
 import json
+import re
 import threading
+import time
+import atexit
+from contextlib import contextmanager
 
 DB_FILE = 'smarthome.db'
 db_lock = threading.Lock()
 
+# --- CONNECTION MANAGER ---
+# - Ghi: 1 connection dùng chung cả process, chỉ dùng trong db_lock (SQLite chỉ cho 1 writer).
+# - Đọc: connection chỉ đọc lấy từ pool dùng chung và gắn với luồng tới khi luồng trả lại
+#   (release_thread_conn). Werkzeug chạy mỗi request Flask trong 1 luồng mới, nên main trả
+#   connection cuối mỗi request thay vì mở mới + chạy lại PRAGMA cho từng request.
+#   Luồng chạy lâu (poll, flush, MCP...) giữ luôn connection của mình.
+# DB chạy WAL: luồng đọc không bị chặn bởi luồng poll đang ghi (và ngược lại).
+READ_POOL_MAX = 8   # Số connection đọc rảnh giữ lại trong pool
+
+class PooledConnection(sqlite3.Connection):
+    settings_checked = None     # (DB_FILE, data_version, settings_version) lần kiểm tra settings gần nhất
+
+_local = threading.local()
+_write = None       # (DB_FILE, connection)
+_read_pool = []     # [(DB_FILE, connection)] đang rảnh
+_pool_lock = threading.Lock()
+
+def _connect(query_only=False):
+    conn = sqlite3.connect(DB_FILE, timeout=10, cached_statements=256, check_same_thread=False, factory=PooledConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")   # An toàn với WAL, fsync ít hơn nhiều
+    conn.execute("PRAGMA cache_size=-8000")     # 8MB page cache / connection
+    conn.execute("PRAGMA temp_store=MEMORY")
+    if query_only: conn.execute("PRAGMA query_only=1")
+    return conn
+
+def _close(conn):
+    try: conn.close()
+    except: pass
+
+def get_conn():
+    """Connection ghi dùng chung (chỉ dùng trong db_lock)."""
+    global _write
+    # Đổi DB_FILE (VD: benchmark/test) -> mở connection mới
+    if _write is None or _write[0] != DB_FILE:
+        if _write: _close(_write[1])
+        _write = (DB_FILE, _connect())
+    return _write[1]
+
+def get_read_conn():
+    """Connection chỉ đọc của luồng hiện tại (lần đầu lấy từ pool), không cần db_lock."""
+    cached = getattr(_local, 'read', None)
+    if cached and cached[0] == DB_FILE: return cached[1]
+    if cached: _close(cached[1])
+    conn = None
+    with _pool_lock:
+        while _read_pool and conn is None:
+            db_file, c = _read_pool.pop()
+            if db_file == DB_FILE: conn = c
+            else: _close(c)
+    if conn is None: conn = _connect(query_only=True)
+    _local.read = (DB_FILE, conn)
+    return conn
+
+def release_thread_conn():
+    """Trả connection đọc của luồng hiện tại về pool (luồng ngắn hạn gọi khi xong việc)."""
+    cached = getattr(_local, 'read', None)
+    if not cached: return
+    _local.read = None
+    with _pool_lock:
+        if cached[0] == DB_FILE and len(_read_pool) < READ_POOL_MAX:
+            _read_pool.append(cached)
+            return
+    _close(cached[1])
+
+@contextmanager
+def write_conn():
+    """Xếp hàng ghi + commit khi xong, rollback nếu lỗi."""
+    with db_lock:
+        conn = get_conn()
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    with db_lock:
+        create_tables(get_conn())
+    migrate_dps_blobs()
+
+def create_tables(conn):
     c = conn.cursor()
     # Table 'devices' will store both static config and dynamic state
     # We use a JSON column for 'mapping', 'dps', etc. for flexibility
@@ -31,6 +117,44 @@ def init_db():
         last_update REAL,
         missing_ip BOOLEAN
     )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_devices_parent ON devices(parent)")
+
+    # Table 'device_dps': 1 row per DP (value is JSON-encoded) instead of the devices.dps blob
+    c.execute('''CREATE TABLE IF NOT EXISTS device_dps (
+        device_id TEXT,
+        dp_id TEXT,
+        value TEXT,        -- json.dumps(value)
+        type TEXT,         -- 'bool', 'int', 'float', 'str', 'json'
+        updated_at REAL,
+        PRIMARY KEY (device_id, dp_id)
+    ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_device_dps_dp ON device_dps(dp_id)")
+
+    # Table 'dp_history': append-only raw DP changes (fed from poll change detection)
+    c.execute('''CREATE TABLE IF NOT EXISTS dp_history (
+        device_id TEXT,
+        dp_id TEXT,
+        ts REAL,
+        value TEXT,        -- json.dumps(value)
+        num REAL           -- numeric value (bool -> 0/1), NULL for text
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dp_history ON dp_history(device_id, dp_id, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dp_history_ts ON dp_history(ts)")
+
+    # Table 'dp_history_agg': minute/hour/day rollups of dp_history
+    c.execute('''CREATE TABLE IF NOT EXISTS dp_history_agg (
+        device_id TEXT,
+        dp_id TEXT,
+        resolution INTEGER, -- 60, 3600, 86400
+        bucket INTEGER,     -- bucket start (epoch seconds)
+        count INTEGER,
+        sum REAL,
+        min REAL,
+        max REAL,
+        last TEXT,          -- last raw value in the bucket
+        PRIMARY KEY (device_id, dp_id, resolution, bucket)
+    ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dp_history_agg_bucket ON dp_history_agg(resolution, bucket)")
 
     # Table 'bql_emails' for storing notifications and bills
     c.execute('''CREATE TABLE IF NOT EXISTS bql_emails (
@@ -41,7 +165,25 @@ def init_db():
         content_type TEXT, -- 'BILL' or 'NOTICE'
         summary TEXT,      -- Text content or summary
         metadata TEXT,     -- JSON for extra details (e.g. amount, month)
-        is_announced BOOLEAN DEFAULT 0
+        is_announced BOOLEAN DEFAULT 0,
+        message_id TEXT    -- Message-ID header (dedupe key for IMAP sync)
+    )''')
+    c.execute("PRAGMA table_info(bql_emails)")
+    if 'message_id' not in [r[1] for r in c.fetchall()]:
+        c.execute("ALTER TABLE bql_emails ADD COLUMN message_id TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bql_message_id ON bql_emails(message_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bql_type_announced ON bql_emails(content_type, is_announced)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bql_sender_subject_time ON bql_emails(sender, subject, received_at)")
+    init_email_fts(c)
+
+    # Table 'imap_sync': incremental IMAP sync position per account/mailbox
+    c.execute('''CREATE TABLE IF NOT EXISTS imap_sync (
+        account TEXT,
+        mailbox TEXT,
+        uidvalidity INTEGER,
+        last_uid INTEGER,      -- highest UID already handled
+        sender_filter TEXT,    -- filter used for that scan (changed filter -> rescan window)
+        PRIMARY KEY (account, mailbox)
     )''')
 
     # Table 'settings' for key-value configuration
@@ -49,14 +191,58 @@ def init_db():
         key TEXT PRIMARY KEY,
         value TEXT
     )''')
+    init_meta(c)
+
+    # Table 'timers' for pending on/off timers (survive restarts)
+    c.execute('''CREATE TABLE IF NOT EXISTS timers (
+        dev_id TEXT,
+        dp_id TEXT,        -- '' = whole device
+        action TEXT,       -- 'on' or 'off'
+        end_time REAL,     -- epoch seconds
+        PRIMARY KEY (dev_id, dp_id)
+    )''')
     conn.commit()
-    conn.close()
+
+def migrate_dps_blobs():
+    """Move old devices.dps JSON blobs into device_dps (existing rows win), then clear the blobs."""
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, dps, last_update FROM devices WHERE dps IS NOT NULL AND dps != ''")
+        rows = c.fetchall()
+        for r in rows:
+            try: dps = json.loads(r['dps']) or {}
+            except: dps = {}
+            c.executemany("INSERT OR IGNORE INTO device_dps (device_id, dp_id, value, type, updated_at) VALUES (?, ?, ?, ?, ?)",
+                          dps_rows(r['id'], dps, r['last_update'] or 0))
+        if rows:
+            c.execute("UPDATE devices SET dps = NULL WHERE dps IS NOT NULL")
+
+def dp_type(value):
+    if isinstance(value, bool): return 'bool'
+    if isinstance(value, int): return 'int'
+    if isinstance(value, float): return 'float'
+    if isinstance(value, str): return 'str'
+    return 'json'
+
+def dps_rows(dev_id, dps, ts):
+    return [(dev_id, str(k), json.dumps(v, ensure_ascii=False), dp_type(v), ts) for k, v in dps.items()]
+
+UPSERT_DP_SQL = '''INSERT INTO device_dps (device_id, dp_id, value, type, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(device_id, dp_id) DO UPDATE SET value = excluded.value, type = excluded.type, updated_at = excluded.updated_at'''
+
+def load_dps(c, where="", params=()):
+    """Read device_dps rows -> {device_id: {dp_id: value}}"""
+    c.execute(f"SELECT device_id, dp_id, value FROM device_dps {where}", params)
+    result = {}
+    for device_id, dp_id, value in c.fetchall():
+        try: v = json.loads(value)
+        except: v = value
+        result.setdefault(device_id, {})[dp_id] = v
+    return result
 
 def upsert_device(dev_data):
     """Insert or Update device. fields not present in dev_data will be kept as is if updating."""
-    with db_lock:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
+    with write_conn() as conn:
         c = conn.cursor()
         
         dev_id = dev_data.get('id')
@@ -80,8 +266,8 @@ def upsert_device(dev_data):
             values = []
             
             for k, v in dev_data.items():
-                if k == 'id': continue
-                if k in ['mapping', 'dps']:
+                if k in ('id', 'dps'): continue
+                if k == 'mapping':
                      update_fields.append(f"{k} = ?")
                      values.append(safe_json(v))
                 else:
@@ -111,7 +297,6 @@ def upsert_device(dev_data):
                 'node_id': dev_data.get('node_id', ''),
                 'parent': dev_data.get('parent', ''),
                 'mapping': json.dumps(dev_data.get('mapping', {}), ensure_ascii=False),
-                'dps': json.dumps(dev_data.get('dps', {}), ensure_ascii=False),
                 'online': dev_data.get('online', False),
                 'last_update': dev_data.get('last_update', 0),
                 'missing_ip': dev_data.get('missing_ip', True)
@@ -119,89 +304,495 @@ def upsert_device(dev_data):
             cols = ', '.join(row.keys())
             qmarks = ', '.join(['?'] * len(row))
             c.execute(f"INSERT INTO devices ({cols}) VALUES ({qmarks})", list(row.values()))
-            
-        conn.commit()
-        conn.close()
+
+        # DP state lives in device_dps
+        if dev_data.get('dps'):
+            c.executemany(UPSERT_DP_SQL, dps_rows(dev_id, dev_data['dps'], dev_data.get('last_update') or time.time()))
+
+def parse_device_row(r, dps_map):
+    d = dict(r)
+    # Parse JSON columns
+    try: d['mapping'] = json.loads(d['mapping']) if d['mapping'] else {}
+    except: d['mapping'] = {}
+    
+    # Old blob (not migrated yet) + device_dps rows -> same 'dps' dict as before
+    try: d['dps'] = json.loads(d['dps']) if d['dps'] else {}
+    except: d['dps'] = {}
+    d['dps'].update(dps_map.get(d['id'], {}))
+    return d
 
 def get_all_devices():
     """Return list of dicts with properly parsed JSON fields"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_read_conn()
     c = conn.cursor()
     c.execute("SELECT * FROM devices")
     rows = c.fetchall()
-    conn.close()
+    dps_map = load_dps(c)
     
-    devices = []
-    for r in rows:
-        d = dict(r)
-        # Parse JSON columns
-        try: d['mapping'] = json.loads(d['mapping']) if d['mapping'] else {}
-        except: d['mapping'] = {}
-        
-        try: d['dps'] = json.loads(d['dps']) if d['dps'] else {}
-        except: d['dps'] = {}
-        
-        devices.append(d)
-    return devices
+    with _pending_lock:
+        return [_overlay_pending(parse_device_row(r, dps_map)) for r in rows]
+
+def get_device(dev_id):
+    """Return one device (same format as get_all_devices) or None"""
+    conn = get_read_conn()
+    c = conn.cursor()
+    c.execute("SELECT * FROM devices WHERE id = ?", (dev_id,))
+    row = c.fetchone()
+    if not row: return None
+    dps_map = load_dps(c, "WHERE device_id = ?", (dev_id,))
+    with _pending_lock:
+        return _overlay_pending(parse_device_row(row, dps_map))
+
+def get_children(parent_id):
+    """Return sub-devices (Zigbee) of a gateway"""
+    conn = get_read_conn()
+    c = conn.cursor()
+    c.execute("SELECT * FROM devices WHERE parent = ?", (parent_id,))
+    rows = c.fetchall()
+    dps_map = load_dps(c, "WHERE device_id IN (SELECT id FROM devices WHERE parent = ?)", (parent_id,))
+    with _pending_lock:
+        return [_overlay_pending(parse_device_row(r, dps_map)) for r in rows]
+
+def get_dp_values(dp_id):
+    """Value of one DP across all devices: {device_id: value} (uses idx_device_dps_dp)"""
+    conn = get_read_conn()
+    c = conn.cursor()
+    result = {dev_id: dps[str(dp_id)] for dev_id, dps in load_dps(c, "WHERE dp_id = ?", (str(dp_id),)).items()}
+    with _pending_lock:
+        for dev_id, entry in _pending_state.items():
+            if str(dp_id) in entry["dps"]: result[dev_id] = entry["dps"][str(dp_id)]
+    return result
+
+# --- DEVICE STATE (WRITE-BEHIND) ---
+# update_device_state() chỉ gom thay đổi vào RAM (nhiều lần ghi cùng thiết bị gộp làm 1),
+# luồng nền ghi cả lô trong 1 transaction mỗi STATE_FLUSH_INTERVAL giây hoặc khi đủ
+# STATE_FLUSH_MAX thiết bị. Đường nóng (poll, điều khiển, timer) không phải chờ commit.
+STATE_FLUSH_INTERVAL = 1.0
+STATE_FLUSH_MAX = 200
+
+_pending_state = {}     # dev_id -> {"dps": {...}, "online": bool, "ts": float}
+_pending_history = []   # (device_id, dp_id, ts, value, num) chờ ghi vào dp_history
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()   # 1 lần flush tại 1 thời điểm -> lô cũ không ghi đè lô mới
+_flush_event = threading.Event()
+_flush_thread = None
 
 def update_device_state(dev_id, dps_dict, is_online=True):
-    with db_lock:
-        conn = sqlite3.connect(DB_FILE)
+    with _pending_lock:
+        entry = _pending_state.get(dev_id)
+        if entry is None:
+            entry = _pending_state[dev_id] = {"dps": {}, "online": is_online, "ts": 0}
+        entry["dps"].update(dps_dict)
+        entry["online"] = is_online
+        entry["ts"] = time.time()
+        pending = len(_pending_state)
+        _ensure_flusher()
+    if pending >= STATE_FLUSH_MAX:
+        _flush_event.set()
+
+def _ensure_flusher():
+    # Gọi trong _pending_lock
+    global _flush_thread
+    if _flush_thread is None:
+        _flush_thread = threading.Thread(target=_flush_loop, daemon=True, name='db-state-flush')
+        _flush_thread.start()
+
+def flush_device_states():
+    """Ghi ngay mọi trạng thái đang chờ xuống DB (1 transaction). Trả về số thiết bị đã ghi."""
+    global _pending_state, _pending_history
+    with _flush_lock:
+        with _pending_lock:
+            batch, _pending_state = _pending_state, {}
+            history, _pending_history = _pending_history, []
+        if not batch and not history: return 0
+
+        try:
+            with write_conn() as conn:
+                c = conn.cursor()
+                if history:
+                    c.executemany("INSERT INTO dp_history (device_id, dp_id, ts, value, num) VALUES (?, ?, ?, ?, ?)", history)
+                for dev_id, entry in batch.items():
+                    c.execute("UPDATE devices SET online = ?, last_update = ? WHERE id = ?",
+                              (entry["online"], entry["ts"], dev_id))
+                    if c.rowcount == 0: continue  # Thiết bị không có trong DB
+                    # Mỗi DP đổi = 1 row, không đọc/ghi lại cả bộ dps
+                    c.executemany(UPSERT_DP_SQL, dps_rows(dev_id, entry["dps"], entry["ts"]))
+        except:
+            _requeue(batch, history)
+            raise
+        return len(batch)
+
+def _requeue(batch, history):
+    """Ghi lỗi (VD: database is locked) -> trả lô về hàng chờ để lần flush sau ghi lại, bản mới hơn được giữ."""
+    global _pending_history
+    with _pending_lock:
+        for dev_id, entry in batch.items():
+            newer = _pending_state.get(dev_id)
+            if newer:
+                entry["dps"].update(newer["dps"])
+                entry["online"] = newer["online"]
+                entry["ts"] = newer["ts"]
+            _pending_state[dev_id] = entry
+        _pending_history = history + _pending_history
+
+def _flush_loop():
+    while True:
+        _flush_event.wait(STATE_FLUSH_INTERVAL)
+        _flush_event.clear()
+        try: flush_device_states()
+        except Exception as e: print(f"DB state flush error: {e}")
+
+def _overlay_pending(d):
+    """Đọc DB nhưng trạng thái chưa flush vẫn phải thấy được (read-your-writes)."""
+    entry = _pending_state.get(d.get('id'))
+    if entry:
+        d['dps'].update(entry["dps"])
+        d['online'] = entry["online"]
+        d['last_update'] = entry["ts"]
+    return d
+
+# Thoát chương trình bình thường -> không mất trạng thái đang chờ
+atexit.register(flush_device_states)
+
+# --- DP HISTORY ---
+# Ghi: record_history() gom vào cùng lô write-behind với update_device_state.
+# Rollup: rollup_history() gộp raw -> phút -> giờ -> ngày (chạy định kỳ ở luồng nền của main).
+# Retention (số ngày, 0 = giữ mãi) chỉnh trong bảng settings.
+HISTORY_FLUSH_MAX = 2000
+HISTORY_LATE_MARGIN = 10     # Giây chờ lô write-behind cuối ghi xong trước khi rollup
+HISTORY_RESOLUTIONS = [(60, 0), (3600, 60), (86400, 3600)]   # (resolution, nguồn: 0 = raw)
+HISTORY_RETENTION = {        # settings key -> (resolution, số ngày mặc định)
+    'history_raw_days': (0, 7),
+    'history_minute_days': (60, 30),
+    'history_hour_days': (3600, 365),
+    'history_day_days': (86400, 0),
+}
+HISTORY_RAW_STEP = 10        # Khoảng cách ước lượng giữa 2 điểm raw, để chọn độ phân giải khi query
+
+def history_num(value):
+    if isinstance(value, bool): return 1.0 if value else 0.0
+    if isinstance(value, (int, float)): return float(value)
+    return None
+
+def record_history(dev_id, changes, ts=None):
+    """Thêm các DP vừa đổi giá trị vào lịch sử (ghi theo lô, không chặn luồng gọi)."""
+    if not changes: return
+    ts = ts or time.time()
+    rows = [(dev_id, str(k), ts, json.dumps(v, ensure_ascii=False), history_num(v)) for k, v in changes.items()]
+    with _pending_lock:
+        _pending_history.extend(rows)
+        pending = len(_pending_history)
+        _ensure_flusher()
+    if pending >= HISTORY_FLUSH_MAX:
+        _flush_event.set()
+
+def get_history_watermark(resolution):
+    """End (epoch seconds) of the range already rolled up at this resolution (table 'meta')."""
+    try: return float(get_meta_version(get_read_conn().cursor(), f'history_rollup_{resolution}'))
+    except: return 0.0
+
+def rollup_history(now=None):
+    """Gộp các khoảng thời gian đã trọn vẹn vào bảng dp_history_agg. Trả về số bucket đã ghi."""
+    now = now or time.time()
+    total = 0
+    for resolution, source in HISTORY_RESOLUTIONS:
+        start = get_history_watermark(resolution)
+        # Chỉ gộp bucket đã kết thúc (và nguồn của nó đã được gộp xong)
+        limit = now - HISTORY_LATE_MARGIN if source == 0 else get_history_watermark(source)
+        end = int(limit // resolution) * resolution
+        if end <= start: continue
+
+        with write_conn() as conn:
+            c = conn.cursor()
+            if source == 0:
+                c.execute('''INSERT INTO dp_history_agg (device_id, dp_id, resolution, bucket, count, sum, min, max, last)
+                    SELECT device_id, dp_id, ?, b, n, s, lo, hi,
+                        (SELECT h.value FROM dp_history h WHERE h.device_id = g.device_id AND h.dp_id = g.dp_id
+                            AND h.ts >= b AND h.ts < b + ? ORDER BY h.ts DESC LIMIT 1)
+                    FROM (SELECT device_id, dp_id, CAST(ts / ? AS INTEGER) * ? AS b,
+                            COUNT(*) AS n, SUM(num) AS s, MIN(num) AS lo, MAX(num) AS hi
+                          FROM dp_history WHERE ts >= ? AND ts < ?
+                          GROUP BY device_id, dp_id, b) g
+                    WHERE 1
+                    ON CONFLICT(device_id, dp_id, resolution, bucket) DO UPDATE SET
+                        count = count + excluded.count, sum = coalesce(sum, 0) + coalesce(excluded.sum, 0),
+                        min = min(coalesce(min, excluded.min), coalesce(excluded.min, min)),
+                        max = max(coalesce(max, excluded.max), coalesce(excluded.max, max)),
+                        last = excluded.last''',
+                          (resolution, resolution, resolution, resolution, start, end))
+            else:
+                c.execute('''INSERT INTO dp_history_agg (device_id, dp_id, resolution, bucket, count, sum, min, max, last)
+                    SELECT device_id, dp_id, ?, b, n, s, lo, hi,
+                        (SELECT a.last FROM dp_history_agg a WHERE a.device_id = g.device_id AND a.dp_id = g.dp_id
+                            AND a.resolution = ? AND a.bucket >= b AND a.bucket < b + ? ORDER BY a.bucket DESC LIMIT 1)
+                    FROM (SELECT device_id, dp_id, (bucket / ?) * ? AS b,
+                            SUM(count) AS n, SUM(sum) AS s, MIN(min) AS lo, MAX(max) AS hi
+                          FROM dp_history_agg WHERE resolution = ? AND bucket >= ? AND bucket < ?
+                          GROUP BY device_id, dp_id, b) g
+                    WHERE 1
+                    ON CONFLICT(device_id, dp_id, resolution, bucket) DO UPDATE SET
+                        count = count + excluded.count, sum = coalesce(sum, 0) + coalesce(excluded.sum, 0),
+                        min = min(coalesce(min, excluded.min), coalesce(excluded.min, min)),
+                        max = max(coalesce(max, excluded.max), coalesce(excluded.max, max)),
+                        last = excluded.last''',
+                          (resolution, source, resolution, resolution, resolution, source, start, end))
+            total += c.rowcount
+            c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f'history_rollup_{resolution}', end))
+    return total
+
+def history_retention():
+    """{resolution: số ngày} từ settings (0 = giữ mãi)."""
+    result = {}
+    for key, (resolution, default) in HISTORY_RETENTION.items():
+        try: result[resolution] = float(get_setting(key, default))
+        except: result[resolution] = default
+    return result
+
+def prune_history(now=None):
+    """Xoá dữ liệu lịch sử quá hạn giữ theo từng độ phân giải."""
+    now = now or time.time()
+    with write_conn() as conn:
         c = conn.cursor()
-        # First get current dps to merge
-        c.execute("SELECT dps FROM devices WHERE id = ?", (dev_id,))
-        row = c.fetchone()
-        if row:
-            current_dps_str = row[0]
-            try: current_dps = json.loads(current_dps_str) if current_dps_str else {}
-            except: current_dps = {}
-            
-            current_dps.update(dps_dict)
-            new_dps_str = json.dumps(current_dps, ensure_ascii=False)
-            
-            import time
-            c.execute("UPDATE devices SET dps = ?, online = ?, last_update = ? WHERE id = ?", 
-                      (new_dps_str, is_online, time.time(), dev_id))
-            conn.commit()
-        conn.close()
+        for resolution, days in history_retention().items():
+            if days <= 0: continue
+            cutoff = now - days * 86400
+            if resolution == 0:
+                # Không xoá raw chưa được gộp lên mức phút
+                cutoff = min(cutoff, get_history_watermark(60))
+                c.execute("DELETE FROM dp_history WHERE ts < ?", (cutoff,))
+            else:
+                c.execute("DELETE FROM dp_history_agg WHERE resolution = ? AND bucket < ?", (resolution, cutoff))
 
-# --- SETTINGS HELPERS ---
-def get_setting(key, default=None):
-    try:
-        conn = sqlite3.connect(DB_FILE)
+def get_history(dev_id, dp_id, start, end, max_points=500):
+    """
+    Lịch sử 1 DP trong [start, end). Tự chọn độ phân giải nhỏ nhất mà
+    số điểm <= max_points và còn dữ liệu (chưa bị xoá theo retention).
+    Returns: {"resolution": 0|60|3600|86400, "points": [...]}
+        raw:  {"t", "value"}
+        agg:  {"t", "count", "avg", "min", "max", "last"}
+    """
+    now = time.time()
+    span = max(end - start, 1)
+    retention = history_retention()
+    resolution = HISTORY_RESOLUTIONS[-1][0]
+    for res in [0] + [r for r, _ in HISTORY_RESOLUTIONS]:
+        step = res or HISTORY_RAW_STEP
+        days = retention.get(res, 0)
+        if span / step <= max_points and (days <= 0 or start >= now - days * 86400):
+            resolution = res
+            break
+
+    conn = get_read_conn()
+    c = conn.cursor()
+    points = []
+    if resolution == 0:
+        c.execute("SELECT ts, value FROM dp_history WHERE device_id = ? AND dp_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                  (dev_id, str(dp_id), start, end))
+        for r in c.fetchall():
+            try: v = json.loads(r['value'])
+            except: v = r['value']
+            points.append({"t": r['ts'], "value": v})
+    else:
+        c.execute('''SELECT bucket, count, sum, min, max, last FROM dp_history_agg
+                     WHERE device_id = ? AND dp_id = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket''',
+                  (dev_id, str(dp_id), resolution, int(start // resolution) * resolution, end))
+        rows = c.fetchall()
+
+        # Đoạn mới nhất chưa được rollup: gộp trực tiếp từ raw
+        tail = max(start, get_history_watermark(resolution))
+        if tail < end:
+            c.execute('''SELECT b AS bucket, n AS count, s AS sum, lo AS min, hi AS max,
+                            (SELECT h.value FROM dp_history h WHERE h.device_id = ? AND h.dp_id = ?
+                                AND h.ts >= b AND h.ts < b + ? ORDER BY h.ts DESC LIMIT 1) AS last
+                         FROM (SELECT CAST(ts / ? AS INTEGER) * ? AS b, COUNT(*) AS n, SUM(num) AS s, MIN(num) AS lo, MAX(num) AS hi
+                               FROM dp_history WHERE device_id = ? AND dp_id = ? AND ts >= ? AND ts < ? GROUP BY b)
+                         ORDER BY b''',
+                      (dev_id, str(dp_id), resolution, resolution, resolution, dev_id, str(dp_id), tail, end))
+            rows += c.fetchall()
+
+        for r in rows:
+            try: last = json.loads(r['last']) if r['last'] is not None else None
+            except: last = r['last']
+            avg = r['sum'] / r['count'] if r['sum'] is not None and r['count'] and r['min'] is not None else None
+            points.append({"t": r['bucket'], "count": r['count'], "avg": avg, "min": r['min'], "max": r['max'], "last": last})
+    return {"resolution": resolution, "points": points}
+
+# --- TIMER HELPERS ---
+def save_timer(dev_id, dp_id, action, end_time):
+    with write_conn() as conn:
         c = conn.cursor()
-        c.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = c.fetchone()
-        conn.close()
-        return row[0] if row else default
-    except: return default
+        c.execute("INSERT OR REPLACE INTO timers (dev_id, dp_id, action, end_time) VALUES (?, ?, ?, ?)",
+                  (dev_id, dp_id, action, end_time))
 
-def set_setting(key, value):
-    with db_lock:
-        conn = sqlite3.connect(DB_FILE)
+def delete_timer(dev_id, dp_id, end_time=None):
+    """Delete a timer. If end_time is given, only delete the row with that exact end_time."""
+    with write_conn() as conn:
         c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-        conn.commit()
-        conn.close()
+        if end_time is None:
+            c.execute("DELETE FROM timers WHERE dev_id = ? AND dp_id = ?", (dev_id, dp_id))
+        else:
+            c.execute("DELETE FROM timers WHERE dev_id = ? AND dp_id = ? AND end_time = ?", (dev_id, dp_id, end_time))
 
-def get_all_settings():
+def get_all_timers():
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_read_conn()
         c = conn.cursor()
-        c.execute("SELECT key, value FROM settings")
+        c.execute("SELECT dev_id, dp_id, action, end_time FROM timers")
         rows = c.fetchall()
-        conn.close()
-        return {r[0]: r[1] for r in rows}
+        return [dict(r) for r in rows]
+    except: return []
+
+# --- CHANGE COUNTERS (table 'meta') ---
+# Bumped by triggers, so readers in any process can tell cheaply whether to reload.
+# Also holds internal bookkeeping (history rollup watermarks) that must not show up in settings.
+# devices_version only counts config columns: state flushes (online/last_update, device_dps) do not bump it.
+DEVICE_CONFIG_COLUMNS = "name, ip, key, version, category, product_name, product_id, biz_type, model, sub, icon, node_id, parent, mapping"
+
+def init_meta(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER
+    )''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('settings_version', 0)")
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('devices_version', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS settings_version_{event.lower()} AFTER {event} ON settings BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'settings_version';
+        END''')
+    for name, event in (('insert', 'INSERT'), ('update', f'UPDATE OF {DEVICE_CONFIG_COLUMNS}'), ('delete', 'DELETE')):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS devices_version_{name} AFTER {event} ON devices BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'devices_version';
+        END''')
+    # Rollup watermarks used to live in settings (shown in /api/settings, bumped settings_version)
+    c.execute("INSERT OR IGNORE INTO meta (key, value) "
+              "SELECT key, CAST(CAST(value AS REAL) AS INTEGER) FROM settings WHERE key LIKE 'history\\_rollup\\_%' ESCAPE '\\'")
+    c.execute("DELETE FROM settings WHERE key LIKE 'history\\_rollup\\_%' ESCAPE '\\'")
+
+def get_meta_version(c, key):
+    c.execute("SELECT value FROM meta WHERE key = ?", (key,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def get_devices_version():
+    """Change counter of device config (add/rename/IP/key/mapping...). None if unknown (old DB)."""
+    try: return get_meta_version(get_read_conn().cursor(), 'devices_version')
+    except: return None
+
+# --- SETTINGS HELPERS ---
+# The whole settings table is cached in memory (it is small and read very often).
+# - Writes in this process (set_setting/set_settings) drop the cache.
+# - Writes from other processes (MCP servers share the DB) bump meta.settings_version
+#   through triggers. Each read connection checks PRAGMA data_version
+#   (free, no table read) and only looks at settings_version when the DB changed.
+_settings_lock = threading.Lock()
+_settings_cache = None      # (DB_FILE, settings_version, {key: value})
+
+BOOL_TRUE = ('1', 'true', 'yes', 'on')
+
+def invalidate_settings():
+    global _settings_cache
+    with _settings_lock:
+        _settings_cache = None
+
+def _settings():
+    """Cached {key: value}. Do not mutate (get_all_settings returns a copy)."""
+    global _settings_cache
+    conn = get_read_conn()
+    c = conn.cursor()
+    data_version = c.execute("PRAGMA data_version").fetchone()[0]
+    cache = _settings_cache
+    if cache and cache[0] == DB_FILE and conn.settings_checked == (DB_FILE, data_version, cache[1]):
+        return cache[2]
+
+    # Version first, then rows: a write in between only causes one extra reload
+    version = get_meta_version(c, 'settings_version')
+    if not (cache and cache[0] == DB_FILE and cache[1] == version):
+        c.execute("SELECT key, value FROM settings")
+        cache = (DB_FILE, version, {r[0]: r[1] for r in c.fetchall()})
+        with _settings_lock:
+            _settings_cache = cache
+    conn.settings_checked = (DB_FILE, data_version, version)
+    return cache[2]
+
+def get_setting(key, default=None, cast=None):
+    """
+    Value of a setting (str), or default. cast converts it, e.g. get_setting('poll_workers', 8, int);
+    cast=bool accepts '1'/'true'/'yes'/'on'. A value that fails to convert returns default.
+    """
+    try:
+        value = _settings().get(key)
+    except: return default
+    if value is None: return default
+    if cast is None: return value
+    if cast is bool: return value.strip().lower() in BOOL_TRUE
+    try: return cast(value)
+    except: return default
+
+def set_setting(key, value):
+    set_settings({key: value})
+
+def set_settings(values):
+    """Write many settings in one transaction."""
+    try:
+        with write_conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                             [(k, str(v)) for k, v in values.items()])
+    finally:
+        invalidate_settings()
+
+def get_all_settings():
+    try: return dict(_settings())
     except: return {}
 
+# --- EMAIL FULL-TEXT SEARCH (FTS5) ---
+# Contentless FTS5 index over subject + summary, kept in sync by triggers.
+# 'remove_diacritics 2' folds Vietnamese tone marks (hóa -> hoa); 'đ' is a separate
+# letter for unicode61, so it is folded to 'd' before indexing (and in queries).
+def fts_fold_sql(col):
+    return f"replace(replace({col}, 'đ', 'd'), 'Đ', 'D')"
+
+def fts_fold(text):
+    return (text or '').replace('đ', 'd').replace('Đ', 'D')
+
+def init_email_fts(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'bql_emails_fts'")
+    exists = c.fetchone() is not None
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS bql_emails_fts USING fts5(
+            subject, summary, content='', tokenize='unicode61 remove_diacritics 2')''')
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 not available, search_emails falls back to LIKE: {e}")
+        return
+
+    subject, summary = fts_fold_sql('new.subject'), fts_fold_sql('new.summary')
+    old_subject, old_summary = fts_fold_sql('old.subject'), fts_fold_sql('old.summary')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS bql_emails_fts_ai AFTER INSERT ON bql_emails BEGIN
+        INSERT INTO bql_emails_fts(rowid, subject, summary) VALUES (new.id, {subject}, {summary});
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS bql_emails_fts_ad AFTER DELETE ON bql_emails BEGIN
+        INSERT INTO bql_emails_fts(bql_emails_fts, rowid, subject, summary) VALUES ('delete', old.id, {old_subject}, {old_summary});
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS bql_emails_fts_au AFTER UPDATE OF subject, summary ON bql_emails BEGIN
+        INSERT INTO bql_emails_fts(bql_emails_fts, rowid, subject, summary) VALUES ('delete', old.id, {old_subject}, {old_summary});
+        INSERT INTO bql_emails_fts(rowid, subject, summary) VALUES (new.id, {subject}, {summary});
+    END''')
+
+    if not exists:
+        # Backfill emails stored before the index existed
+        c.execute(f'''INSERT INTO bql_emails_fts(rowid, subject, summary)
+            SELECT id, {fts_fold_sql('subject')}, {fts_fold_sql('summary')} FROM bql_emails''')
+
+def fts_query(keyword, op):
+    """'Hóa đơn điện' -> '"hóa"* AND "don"* AND "dien"*' (prefix match, quotes escaped)"""
+    tokens = re.findall(r"\w+", fts_fold(keyword))
+    return f" {op} ".join('"' + t.replace('"', '""') + '"*' for t in tokens)
+
 # --- EMAIL/BILL HELPERS ---
 def add_email(data):
     """
     data dict: received_at, subject, sender, content_type, summary, metadata (dict)
     """
-    with db_lock:
-        conn = sqlite3.connect(DB_FILE)
+    with write_conn() as conn:
         c = conn.cursor()
         
         meta_str = json.dumps(data.get('metadata', {}), ensure_ascii=False)
@@ -210,16 +801,13 @@ def add_email(data):
         # Here we just insert. The logic to avoid duplicate bills should be in email_mcp.py logic
         
         c.execute('''INSERT INTO bql_emails 
-                     (received_at, subject, sender, content_type, summary, metadata, is_announced)
-                     VALUES (?, ?, ?, ?, ?, ?, ?)''', 
+                     (received_at, subject, sender, content_type, summary, metadata, is_announced, message_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', 
                   (data.get('received_at'), data.get('subject'), data.get('sender'),
-                   data.get('content_type'), data.get('summary'), meta_str, 0))
-        conn.commit()
-        conn.close()
+                   data.get('content_type'), data.get('summary'), meta_str, 0, data.get('message_id')))
 
 def get_emails(limit=10, content_type=None):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_read_conn()
     c = conn.cursor()
     
     query = "SELECT * FROM bql_emails"
@@ -234,7 +822,6 @@ def get_emails(limit=10, content_type=None):
     
     c.execute(query, params)
     rows = c.fetchall()
-    conn.close()
     
     results = []
     for r in rows:
@@ -246,13 +833,11 @@ def get_emails(limit=10, content_type=None):
 
 def get_pending_bills():
     """Get BILLs that haven't been announced yet."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_read_conn()
     c = conn.cursor()
     # Get all unannounced bills
     c.execute("SELECT * FROM bql_emails WHERE content_type = 'BILL' AND is_announced = 0")
     rows = c.fetchall()
-    conn.close()
     
     results = []
     for r in rows:
@@ -263,22 +848,34 @@ def get_pending_bills():
     return results
 
 def mark_as_announced(email_id):
-    with db_lock:
-        conn = sqlite3.connect(DB_FILE)
+    with write_conn() as conn:
         c = conn.cursor()
         c.execute("UPDATE bql_emails SET is_announced = 1 WHERE id = ?", (email_id,))
-        conn.commit()
-        conn.close()
 
-def search_emails(keyword):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+def search_emails(keyword, limit=5):
+    """
+    Full-text search in subject/summary, best matches first (bm25, subject weighted x2).
+    Accent-insensitive: 'hoa don dien' matches 'Hóa đơn điện'.
+    All words must match; if nothing does, any word may match.
+    """
+    conn = get_read_conn()
     c = conn.cursor()
-    # Search in subject or summary
-    pattern = f"%{keyword}%"
-    c.execute("SELECT * FROM bql_emails WHERE subject LIKE ? OR summary LIKE ? ORDER BY id DESC LIMIT 5", (pattern, pattern))
-    rows = c.fetchall()
-    conn.close()
+    rows = []
+    try:
+        for op in ("AND", "OR"):
+            query = fts_query(keyword, op)
+            if not query: break
+            c.execute('''SELECT e.* FROM bql_emails_fts
+                         JOIN bql_emails e ON e.id = bql_emails_fts.rowid
+                         WHERE bql_emails_fts MATCH ?
+                         ORDER BY bm25(bql_emails_fts, 2.0, 1.0), e.id DESC LIMIT ?''', (query, limit))
+            rows = c.fetchall()
+            if rows: break
+    except sqlite3.OperationalError:
+        # No FTS5 in this SQLite build -> old LIKE scan
+        pattern = f"%{keyword}%"
+        c.execute("SELECT * FROM bql_emails WHERE subject LIKE ? OR summary LIKE ? ORDER BY id DESC LIMIT ?", (pattern, pattern, limit))
+        rows = c.fetchall()
     
     results = []
     for r in rows:
@@ -294,14 +891,42 @@ def check_email_exists(sender, subject, received_at):
     Return True if exists, False otherwise.
     """
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_read_conn()
         c = conn.cursor()
         # Use a flexible check (exact subject + exact received time)
         # Note: received_at string format must match exactly
         c.execute("SELECT id FROM bql_emails WHERE sender = ? AND subject = ? AND received_at = ?", 
                   (sender, subject, received_at))
         row = c.fetchone()
-        conn.close()
         return row is not None
     except:
         return False
+
+def get_existing_message_ids(message_ids):
+    """Return the subset of message_ids already stored (1 query per 500 ids)."""
+    found = set()
+    ids = [m for m in set(message_ids) if m]
+    try:
+        conn = get_read_conn()
+        c = conn.cursor()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            c.execute(f"SELECT message_id FROM bql_emails WHERE message_id IN ({','.join('?' * len(chunk))})", chunk)
+            found.update(r[0] for r in c.fetchall())
+    except: pass
+    return found
+
+# --- IMAP SYNC STATE ---
+def get_imap_sync(account, mailbox):
+    try:
+        conn = get_read_conn()
+        c = conn.cursor()
+        c.execute("SELECT uidvalidity, last_uid, sender_filter FROM imap_sync WHERE account = ? AND mailbox = ?", (account, mailbox))
+        row = c.fetchone()
+        return dict(row) if row else None
+    except: return None
+
+def set_imap_sync(account, mailbox, uidvalidity, last_uid, sender_filter):
+    with write_conn() as conn:
+        conn.execute('''INSERT OR REPLACE INTO imap_sync (account, mailbox, uidvalidity, last_uid, sender_filter)
+                        VALUES (?, ?, ?, ?, ?)''', (account, mailbox, uidvalidity, last_uid, sender_filter or ''))
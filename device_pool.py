@@ -0,0 +1,179 @@
+# FILE: device_pool.py
+import select
+import threading
+import time
+import logging
+from contextlib import contextmanager
+import tinytuya
+
+# Setup Logger riêng
+logger = logging.getLogger('device_pool')
+
+class PoolEntry:
+    """1 kết nối (socket) tới 1 thiết bị WiFi hoặc 1 Gateway, kèm các object thiết bị con dùng chung."""
+
+    def __init__(self, root):
+        self.root = root            # Object tinytuya giữ socket
+        self.children = {}          # cid -> object tinytuya con (parent=root)
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.closed = False
+
+class DevicePool:
+    """
+    Giữ sẵn kết nối tinytuya (persistent socket) cho các tool MCP.
+
+    - Khóa theo kết nối (ip, thiết bị/Gateway sở hữu socket, key, version): các thiết bị
+      con Zigbee cùng Gateway dùng chung 1 socket, lệnh lặp lại không phải connect +
+      thương lượng session key (3.4/3.5) lại từ đầu.
+    - Mỗi kết nối chỉ 1 lệnh tại 1 thời điểm (entry.lock).
+    - Kiểm tra sức khỏe trước khi dùng (không tốn round-trip): socket bị thiết bị đóng thì
+      đóng phía mình để tinytuya tự kết nối lại; dữ liệu thiết bị tự đẩy lên thì bỏ đi.
+    - Giới hạn max_open socket (đóng kết nối rảnh lâu nhất), đóng kết nối rảnh quá idle_timeout.
+    """
+
+    def __init__(self, max_open=8, idle_timeout=30, timeout=3, retry_limit=2):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retry_limit = retry_limit
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.stats = {"hits": 0, "misses": 0, "reconnects": 0, "evictions": 0, "expired": 0, "overflow": 0}
+
+    @staticmethod
+    def conn_key(dev_info):
+        owner = dev_info.get('parent') if dev_info.get('is_sub') else dev_info['id']
+        return (dev_info.get('ip'), owner, dev_info.get('key'), float(dev_info.get('version', 3.3) or 3.3))
+
+    def _new_root(self, dev_info, persistent=True):
+        ip, owner, key, ver = self.conn_key(dev_info)
+        d = tinytuya.OutletDevice(owner, ip, key, port=dev_info.get('port', tinytuya.TCPPORT))
+        d.set_version(ver)
+        d.set_socketPersistent(persistent)
+        d.set_socketRetryLimit(self.retry_limit)
+        d.set_socketTimeout(self.timeout)
+        return d
+
+    def _device(self, entry, dev_info):
+        """Object để gửi lệnh: root (thiết bị WiFi) hoặc object con gắn vào socket của Gateway."""
+        if not dev_info.get('is_sub'): return entry.root
+        cid = dev_info.get('node_id', dev_info['id'])
+        d = entry.children.get(cid)
+        if d is None:
+            d = tinytuya.OutletDevice(dev_info['id'], cid=cid, parent=entry.root)
+            entry.children[cid] = d
+        return d
+
+    def _close(self, entry):
+        entry.closed = True
+        try: entry.root.close()
+        except: pass
+
+    def _check_health(self, entry):
+        """Socket đã bị đóng phía thiết bị -> đóng để lần gọi tới tự kết nối lại."""
+        sock = entry.root.socket
+        if sock is None: return
+        try:
+            # Đọc được mà không chặn: hoặc là dữ liệu tự đẩy (bỏ đi), hoặc b'' = đã bị đóng
+            while select.select([sock], [], [], 0)[0]:
+                if not sock.recv(4096):
+                    raise ConnectionError("closed by device")
+        except Exception:
+            self.stats["reconnects"] += 1
+            try: entry.root.close()
+            except: pass
+
+    def _acquire_entry(self, key, dev_info):
+        with self.lock:
+            self._ensure_reaper()
+            entry = self.entries.get(key)
+            if entry:
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+            if len(self.entries) >= self.max_open and not self._evict_one():
+                self.stats["overflow"] += 1
+                return None
+            entry = PoolEntry(self._new_root(dev_info))
+            self.entries[key] = entry
+            return entry
+
+    def _evict_one(self):
+        """Đóng kết nối rảnh lâu nhất (đang được dùng thì bỏ qua). Gọi trong self.lock."""
+        for key, entry in sorted(self.entries.items(), key=lambda kv: kv[1].last_used):
+            if entry.lock.acquire(blocking=False):
+                try:
+                    del self.entries[key]
+                    self._close(entry)
+                finally:
+                    entry.lock.release()
+                self.stats["evictions"] += 1
+                return True
+        return False
+
+    @contextmanager
+    def session(self, dev_info):
+        """
+        with pool.session(dev_config) as d: d.set_value(...)
+        dev_config: thiết bị đã xử lý của tuya_mcp (ip/key/version của Gateway nếu là thiết bị con).
+        """
+        if not dev_info.get('ip'): raise ValueError("Missing IP")
+        key = self.conn_key(dev_info)
+        while True:
+            entry = self._acquire_entry(key, dev_info)
+            if entry is None:
+                # Hết chỗ và mọi kết nối đều bận: dùng 1 kết nối tạm như trước đây
+                root = self._new_root(dev_info, persistent=False)
+                tmp = PoolEntry(root)
+                try: yield self._device(tmp, dev_info)
+                finally:
+                    try: root.close()
+                    except: pass
+                return
+            with entry.lock:
+                if entry.closed: continue   # Vừa bị đóng (hết hạn/bị thay) -> lấy lại
+                self._check_health(entry)
+                try:
+                    yield self._device(entry, dev_info)
+                except:
+                    # Lỗi giữa chừng: bỏ socket (có thể còn dữ liệu dở), lần sau kết nối lại
+                    try: entry.root.close()
+                    except: pass
+                    raise
+                finally:
+                    entry.last_used = time.monotonic()
+                return
+
+    def expire_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if now - entry.last_used < self.idle_timeout: continue
+                if not entry.lock.acquire(blocking=False): continue
+                try:
+                    del self.entries[key]
+                    self._close(entry)
+                    self.stats["expired"] += 1
+                finally:
+                    entry.lock.release()
+
+    def close_all(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        for entry in entries:
+            with entry.lock:
+                self._close(entry)
+
+    def _ensure_reaper(self):
+        if self.reaper is None or not self.reaper.is_alive():
+            self.reaper = threading.Thread(target=self._reap_loop, daemon=True, name='device-pool-reaper')
+            self.reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 3, 1))
+            try: self.expire_idle()
+            except Exception as e: logger.error(f"Pool reaper error: {e}")
@@ -21,8 +21,16 @@ except ImportError:
 
 logger = logging.getLogger('email_module')
 
+MAILBOX = "inbox"
+HEADER_FIELDS = "MESSAGE-ID FROM SUBJECT DATE"
+
+def default_imap_factory(host, port):
+    return imaplib.IMAP4_SSL(host, port)
+
 class EmailMCP:
-    def __init__(self):
+    def __init__(self, imap_factory=None):
+        # imap_factory(host, port) -> đối tượng kiểu imaplib.IMAP4 (test: IMAP giả lập, xem fake_imap_server.py)
+        self.imap_factory = imap_factory or default_imap_factory
         self.running = True
         self.thread = threading.Thread(target=self.loop, daemon=True)
         self.last_check_date = None
@@ -71,168 +79,255 @@ class EmailMCP:
             time.sleep(30) # Check every 30s
 
     def check_mail(self):
+        """
+        Đồng bộ tăng dần theo UID:
+        - Nhớ UIDVALIDITY + UID lớn nhất đã xử lý (bảng imap_sync), lần sau chỉ hỏi UID mới.
+          UIDVALIDITY đổi / chưa có / đổi bộ lọc người gửi -> quét lại cửa sổ email_scan_days.
+        - Chỉ tải header cho các UID mới, lọc trùng theo Message-ID bằng 1 câu query.
+        - Chỉ tải nội dung đầy đủ cho email thật sự mới.
+        - Mốc UID chỉ tiến tới UID liên tục cuối cùng đã lưu/bỏ qua vì trùng: email lỗi được thử lại lần sau.
+        """
         settings = db_manager.get_all_settings()
         username = settings.get('email_account')
         password = settings.get('email_password')
-        sender_filter = settings.get('email_sender')
+        sender_filter = settings.get('email_sender') or ''
         bill_keyword = settings.get('bill_subject_keyword', 'Thông báo phí')
         
         if not username or not password:
             logger.warning("⚠️ Email credentials missing in Settings.")
             return
 
+        mail = None
         try:
             # Connect IMAP (Configurable)
             imap_host = settings.get('imap_host', 'imap.gmail.com')
             imap_port = int(settings.get('imap_port', 993))
             
-            mail = imaplib.IMAP4_SSL(imap_host, imap_port)
+            mail = self.imap_factory(imap_host, imap_port)
             mail.login(username, password)
-            mail.select("inbox")
-
-            # Calculate date range
-            scan_days = int(settings.get('email_scan_days', 30))
-            if scan_days < 1: scan_days = 1
-            
-            today = datetime.now() 
-            # Note: timedelta(days=0) is today. So subtract (scan_days - 1).
-            # If scan_days=1 (Today) -> delta=0 -> SINCE Today
-            # If scan_days=30 -> delta=29 -> SINCE 29 days ago
-            days_ago_date = today - timedelta(days=scan_days - 1)
-            since_str = days_ago_date.strftime("%d-%b-%Y")
-            
-            search_crit = f'(SINCE "{since_str}")'
-            if sender_filter:
-                search_crit = f'(SINCE "{since_str}" FROM "{sender_filter}")'
-            
-            status, messages = mail.search(None, search_crit)
+            status, _ = mail.select(MAILBOX)
             if status != "OK": return
 
-            mail_ids = messages[0].split()
-            # Process last 10 emails only to be safe
-            mail_ids = mail_ids[-10:] if len(mail_ids) > 10 else mail_ids
-            logger.info(f"📩 Found {len(mail_ids)} potential emails.")
+            uidvalidity = self.get_uidvalidity(mail)
+            account = f"{username}@{imap_host}"
+            state = db_manager.get_imap_sync(account, MAILBOX)
+            incremental = bool(state and uidvalidity and state['uidvalidity'] == uidvalidity
+                               and state['sender_filter'] == sender_filter)
 
-            for mid in mail_ids:
-                res, msg_data = mail.fetch(mid, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        # Decorre Subject
-                        subject, encoding = decode_header(msg["Subject"])[0]
-                        if isinstance(subject, bytes):
-                            subject = subject.decode(encoding if encoding else "utf-8")
-                        
-                        sender = msg.get("From")
-                        
-                        # Parse Date
-                        date_str = msg.get("Date")
-                        dt = datetime.now()
-                        if date_str:
-                            try:
-                                dt = email.utils.parsedate_to_datetime(date_str)
-                            except: pass
-                        
-                        received_at = dt.strftime("%Y-%m-%d %H:%M:%S")
+            if incremental:
+                last_uid = state['last_uid']
+                search_crit = f'(UID {last_uid + 1}:*)'
+            else:
+                last_uid = 0
+                # Calculate date range
+                scan_days = int(settings.get('email_scan_days', 30))
+                if scan_days < 1: scan_days = 1
+                # SINCE (scan_days - 1) ngày trước: scan_days=1 -> hôm nay
+                days_ago_date = datetime.now() - timedelta(days=scan_days - 1)
+                since_str = days_ago_date.strftime("%d-%b-%Y")
+                search_crit = f'(SINCE "{since_str}")'
+            if sender_filter:
+                search_crit = f'{search_crit[:-1]} FROM "{sender_filter}")'
 
-                        # DEDUPLICATION CHECK
-                        if db_manager.check_email_exists(sender, subject, received_at):
-                            logger.info(f"   -> [Skip] Email already exists: {subject}")
-                            continue
+            status, messages = mail.uid('SEARCH', None, search_crit)
+            if status != "OK": return
 
-                        logger.info(f"Processing: {subject} | From: {sender} | Date: {received_at}")
+            # "N:*" luôn trả về ít nhất UID cao nhất, kể cả khi nó < N
+            uids = sorted(u for u in (int(x) for x in messages[0].split()) if u > last_uid)
+            logger.info(f"📩 {len(uids)} new UIDs ({'incremental' if incremental else 'full scan'}, last UID {last_uid}).")
+
+            headers = self.fetch_headers(mail, uids)
+            existing = db_manager.get_existing_message_ids(h['message_id'] for h in headers.values())
+            seen = set()
+            # UID lớn nhất mà mọi UID mới <= nó đã được lưu (hoặc cố ý bỏ qua vì trùng).
+            # Email lỗi (không có header, tải nội dung lỗi, lưu DB lỗi) chặn mốc lại để lần sau thử lại.
+            done = last_uid
+            contiguous = True
+            for uid in uids:
+                h = headers.get(uid)
+                is_new = False
+                if not h:
+                    logger.warning(f"   -> [Retry] No header for UID {uid}, will retry next time.")
+                    ok = False
+                else:
+                    ok = True
+                    mid = h['message_id']
+                    if mid and (mid in existing or mid in seen):
+                        logger.info(f"   -> [Skip] Email already exists: {h['subject']}")
+                    # Email lưu trước khi có cột message_id / email không có Message-ID
+                    elif (not incremental or not mid) and db_manager.check_email_exists(h['sender'], h['subject'], h['received_at']):
+                        logger.info(f"   -> [Skip] Email already exists: {h['subject']}")
+                    else:
+                        is_new = True
+                        ok = self.fetch_and_process(mail, uid, h, bill_keyword)
+                    if ok and mid: seen.add(mid)
+
+                if not ok:
+                    contiguous = False
+                elif contiguous:
+                    done = uid
+                    # Lưu tiến độ sau mỗi email mới: lỗi giữa chừng không gửi thông báo lặp lại
+                    if is_new and uidvalidity:
+                        db_manager.set_imap_sync(account, MAILBOX, uidvalidity, uid, sender_filter)
+
+            if uidvalidity and done > last_uid:
+                db_manager.set_imap_sync(account, MAILBOX, uidvalidity, done, sender_filter)
+        except Exception as e:
+            logger.error(f"IMAP Error: {e}")
+            traceback.print_exc()
+        finally:
+            if mail:
+                try:
+                    mail.close()
+                    mail.logout()
+                except: pass
+
+    def fetch_and_process(self, mail, uid, h, bill_keyword):
+        """Tải nội dung đầy đủ 1 email mới rồi lưu. True nếu đã lưu xong."""
+        try:
+            status, msg_data = mail.uid('FETCH', str(uid), "(RFC822)")
+            raw = next((p[1] for p in msg_data if isinstance(p, tuple)), None) if status == "OK" else None
+            if not raw:
+                logger.warning(f"   -> [Retry] Empty body for UID {uid}, will retry next time.")
+                return False
+            self.process_message(email.message_from_bytes(raw), h, bill_keyword)
+            return True
+        except Exception as e:
+            logger.error(f"Error processing email UID {uid}: {e}")
+            return False
 
-                        # Determine Type
-                        content_type = 'NOTICE'
-                        is_bill = False
-                        if bill_keyword.lower() in subject.lower():
-                            content_type = 'BILL'
-                            is_bill = True
-                        
-                        logger.info(f"   -> [Detection] Type: {content_type}, Is Bill: {is_bill} (Keyword: '{bill_keyword}')")
+    def get_uidvalidity(self, mail):
+        """UIDVALIDITY của hộp thư vừa select (None nếu server không trả về)."""
+        try:
+            _, data = mail.response('UIDVALIDITY')
+            if data and data[0]: return int(data[0])
+            status, data = mail.status(MAILBOX, '(UIDVALIDITY)')
+            m = re.search(rb'UIDVALIDITY (\d+)', data[0]) if status == "OK" else None
+            return int(m.group(1)) if m else None
+        except: return None
+
+    def fetch_headers(self, mail, uids, batch=200):
+        """Tải header (không đánh dấu đã đọc) cho nhiều UID -> {uid: {message_id, subject, sender, date, received_at}}"""
+        headers = {}
+        for i in range(0, len(uids), batch):
+            chunk = ",".join(str(u) for u in uids[i:i + batch])
+            status, data = mail.uid('FETCH', chunk, f"(UID BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])")
+            if status != "OK":
+                logger.warning(f"Header fetch failed for {len(uids[i:i + batch])} UIDs: {status}")
+                continue
+            for idx, part in enumerate(data):
+                if not isinstance(part, tuple): continue
+                # Thứ tự item trong FETCH tùy server: "UID n" có thể nằm sau literal (phần tử kế tiếp)
+                m = re.search(rb'UID (\d+)', part[0])
+                if not m and idx + 1 < len(data) and isinstance(data[idx + 1], bytes):
+                    m = re.search(rb'UID (\d+)', data[idx + 1])
+                if not m: continue
+                headers[int(m.group(1))] = self.parse_headers(email.message_from_bytes(part[1]))
+        return headers
+
+    def parse_headers(self, msg):
+        # Decode Subject
+        subject, encoding = decode_header(msg["Subject"] or "")[0]
+        if isinstance(subject, bytes):
+            subject = subject.decode(encoding if encoding else "utf-8")
+        
+        # Parse Date
+        date_str = msg.get("Date")
+        dt = datetime.now()
+        if date_str:
+            try:
+                dt = email.utils.parsedate_to_datetime(date_str)
+            except: pass
+
+        return {
+            "message_id": (msg.get("Message-ID") or "").strip() or None,
+            "subject": subject,
+            "sender": msg.get("From"),
+            "date": dt,
+            "received_at": dt.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def process_message(self, msg, h, bill_keyword):
+        subject, sender, dt, received_at = h['subject'], h['sender'], h['date'], h['received_at']
+        logger.info(f"Processing: {subject} | From: {sender} | Date: {received_at}")
+
+        # Determine Type
+        content_type = 'NOTICE'
+        is_bill = False
+        if bill_keyword.lower() in subject.lower():
+            content_type = 'BILL'
+            is_bill = True
+        
+        logger.info(f"   -> [Detection] Type: {content_type}, Is Bill: {is_bill} (Keyword: '{bill_keyword}')")
 
-                        summary = ""
-                        metadata = {}
+        summary = ""
+        metadata = {}
+        pdf_bytes = None
+        pdf_name = "bill.pdf"
+        
+        # Process Content & Attachments
+        if msg.is_multipart():
+            logger.info("   -> [Structure] Multipart email detected.")
+            for part in msg.walk():
+                c_type = part.get_content_type()
+                c_disp = str(part.get("Content-Disposition"))
+                logger.info(f"     -> [Part] Type: {c_type}, Disp: {c_disp}")
+
+                # 1. Get Text Content
+                if c_type == "text/plain" and "attachment" not in c_disp:
+                    try: 
+                        text_part = part.get_payload(decode=True).decode()
+                        summary += text_part
+                        logger.info(f"       -> Extracted text body: {len(text_part)} chars")
+                    except Exception as e:
+                        logger.error(f"       -> Error reading text part: {e}")
+                
+                # 2. Get PDF Attachment (Only for Bills)
+                if is_bill and "application/pdf" in c_type:
+                    filename = part.get_filename()
+                    if filename:
+                        file_data = part.get_payload(decode=True)
+                        pdf_bytes, pdf_name = file_data, filename
+                        text_content = self.extract_pdf_text(file_data)
+                        logger.info(f"       -> PDF Extracted Text Length: {len(text_content)}")
+                        # Log first 500 chars to debug regex
+                        logger.info(f"       -> [DEBUG PDF TEXT]: {text_content[:500].replace(chr(10), ' ')}")
                         
-                        # Process Content & Attachments
-                        if msg.is_multipart():
-                            logger.info("   -> [Structure] Multipart email detected.")
-                            for part in msg.walk():
-                                c_type = part.get_content_type()
-                                c_disp = str(part.get("Content-Disposition"))
-                                logger.info(f"     -> [Part] Type: {c_type}, Disp: {c_disp}")
-
-                                # 1. Get Text Content
-                                if c_type == "text/plain" and "attachment" not in c_disp:
-                                    try: 
-                                        text_part = part.get_payload(decode=True).decode()
-                                        summary += text_part
-                                        logger.info(f"       -> Extracted text body: {len(text_part)} chars")
-                                    except Exception as e:
-                                        logger.error(f"       -> Error reading text part: {e}")
-                                
-                                # 2. Get PDF Attachment (Only for Bills)
-                                if is_bill and "application/pdf" in c_type:
-                                    filename = part.get_filename()
-                                    if filename:
-                                        file_data = part.get_payload(decode=True)
-                                        text_content = self.extract_pdf_text(file_data)
-                                        logger.info(f"       -> PDF Extracted Text Length: {len(text_content)}")
-                                        # Log first 500 chars to debug regex
-                                        logger.info(f"       -> [DEBUG PDF TEXT]: {text_content[:500].replace(chr(10), ' ')}")
-                                        
-                                        summary += "\n[PDF Content]: " + text_content
-                                        
-                                        # Parse Month/Amount
-                                        meta = self.parse_bill_content(text_content, dt)
-                                        logger.info(f"       -> Parsed Metadata: {meta}")
-                                        metadata.update(meta)
-
-                        else:
-                            # Not multipart
-                            logger.info("   -> [Structure] Single part email.")
-                            try: 
-                                summary = msg.get_payload(decode=True).decode()
-                                logger.info(f"     -> Extracted body: {len(summary)} chars")
-                            except: pass
-
-                        # SAVE TO DB
-                        email_data = {
-                            "received_at": received_at,
-                            "subject": subject,
-                            "sender": sender,
-                            "content_type": content_type,
-                            "summary": summary[:2000], # Limit length
-                            "metadata": metadata
-                        }
-                        db_manager.add_email(email_data)
-                        logger.info(f"   -> [Action] Saved to DB as {content_type}")
+                        summary += "\n[PDF Content]: " + text_content
                         
-                        # SEND TELEGRAM
-                        if is_bill:
-                            logger.info("   -> [Action] Sending Telegram notification...")
-                            # Determine PDF data if available
-                            pdf_bytes = None
-                            pdf_name = "bill.pdf"
-                            
-                            # Search inside parts again? (Inefficient)
-                            # Better: Store it when found
-                            if 'file_data' in locals():
-                                pdf_bytes = file_data
-                                if 'filename' in locals() and filename: pdf_name = filename
-
-                            self.send_telegram_notification(subject, metadata, pdf_bytes, pdf_name)
-                        else:
-                            # Optional: Notify for other important notices
-                            logger.info("   -> [Action] Skipped Telegram (Not a bill)")
-                            pass
-
-            mail.close()
-            mail.logout()
-        except Exception as e:
-            logger.error(f"IMAP Error: {e}")
-            traceback.print_exc()
+                        # Parse Month/Amount
+                        meta = self.parse_bill_content(text_content, dt)
+                        logger.info(f"       -> Parsed Metadata: {meta}")
+                        metadata.update(meta)
+
+        else:
+            # Not multipart
+            logger.info("   -> [Structure] Single part email.")
+            try: 
+                summary = msg.get_payload(decode=True).decode()
+                logger.info(f"     -> Extracted body: {len(summary)} chars")
+            except: pass
+
+        # SAVE TO DB
+        email_data = {
+            "received_at": received_at,
+            "subject": subject,
+            "sender": sender,
+            "content_type": content_type,
+            "summary": summary[:2000], # Limit length
+            "metadata": metadata,
+            "message_id": h['message_id']
+        }
+        db_manager.add_email(email_data)
+        logger.info(f"   -> [Action] Saved to DB as {content_type}")
+        
+        # SEND TELEGRAM
+        if is_bill:
+            logger.info("   -> [Action] Sending Telegram notification...")
+            self.send_telegram_notification(subject, metadata, pdf_bytes, pdf_name)
+        else:
+            # Optional: Notify for other important notices
+            logger.info("   -> [Action] Skipped Telegram (Not a bill)")
 
     def extract_pdf_text(self, data):
         if not PyPDF2: return "[PyPDF2 not installed]"
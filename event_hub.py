@@ -0,0 +1,63 @@
+# FILE: event_hub.py
+import queue
+import threading
+import logging
+
+# Setup Logger riêng
+logger = logging.getLogger('event_hub')
+
+class Subscriber:
+    """1 kết nối stream (VD: 1 tablet). Hàng đợi có giới hạn, đầy thì bị loại."""
+
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.evicted = False
+
+    def get(self, timeout):
+        """Lấy bản tin kế tiếp. None nếu hết thời gian chờ hoặc đã bị loại."""
+        if self.evicted: return None
+        try: return self.queue.get(timeout=timeout)
+        except queue.Empty: return None
+
+class EventHub:
+    """
+    Phát bản tin (đã serialize sẵn) tới nhiều subscriber.
+
+    publish() không bao giờ chặn: subscriber nào đọc không kịp để hàng đợi đầy
+    sẽ bị loại ngay và bị xoá bộ đệm, nên 1 client treo không giữ bộ nhớ hay làm
+    chậm các client khác. Client bị loại tự kết nối lại và đồng bộ bù (Last-Event-ID).
+    """
+
+    def __init__(self, max_queue=64):
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        sub = Subscriber(self.max_queue)
+        with self.lock:
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def has_subscribers(self):
+        return bool(self.subscribers)
+
+    def publish(self, message):
+        with self.lock:
+            subs = list(self.subscribers)
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(message)
+            except queue.Full:
+                self.evict(sub)
+
+    def evict(self, sub):
+        sub.evicted = True
+        self.unsubscribe(sub)
+        with sub.queue.mutex:
+            sub.queue.queue.clear()
+        logger.warning("Stream client too slow, evicted")
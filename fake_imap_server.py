@@ -0,0 +1,207 @@
+# FILE: fake_imap_server.py
+"""
+Server IMAP giả lập (không TLS) chạy trên localhost, đủ lệnh cho EmailMCP.check_mail:
+CAPABILITY, LOGIN, SELECT, STATUS, UID SEARCH (UID a:b, SINCE, FROM), UID FETCH, CLOSE, LOGOUT.
+
+Dùng để thử đồng bộ tăng dần theo UID mà không cần hộp thư thật.
+
+Usage:
+    python fake_imap_server.py --emails 300          # Đồng bộ lần đầu + lần sau (có 5 email mới)
+    python fake_imap_server.py --emails 300 --new 20
+"""
+import argparse
+import email
+import email.utils
+import imaplib
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+class Mailbox:
+    def __init__(self, uidvalidity=None):
+        self.uidvalidity = uidvalidity or int(time.time())
+        self.messages = []      # [(uid, raw bytes, parsed message)]
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        self.stats = {"commands": 0, "bytes_sent": 0, "bodies": 0}
+
+    def add(self, raw):
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages.append((uid, raw, email.message_from_bytes(raw)))
+            return uid
+
+    def add_email(self, subject, body="", sender="bql@example.com", date=None, message_id=None, attachment=None):
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = sender
+        msg["To"] = "home@example.com"
+        msg["Date"] = email.utils.format_datetime(date or datetime.now().astimezone())
+        msg["Message-ID"] = message_id or email.utils.make_msgid(domain="example.com")
+        msg.set_content(body)
+        if attachment:
+            msg.add_attachment(attachment, maintype="application", subtype="pdf", filename="bill.pdf")
+        return self.add(msg.as_bytes())
+
+def parse_uid_set(spec, max_uid):
+    uids = set()
+    for item in spec.split(','):
+        if ':' in item:
+            a, b = item.split(':')
+            a = max_uid if a == '*' else int(a)
+            b = max_uid if b == '*' else int(b)
+            uids.update(range(min(a, b), max(a, b) + 1))
+        else:
+            uids.add(max_uid if item == '*' else int(item))
+    return uids
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def send(self, data):
+        if isinstance(data, str): data = data.encode()
+        self.server.mailbox.stats["bytes_sent"] += len(data)
+        self.wfile.write(data)
+
+    def handle(self):
+        self.send("* OK [CAPABILITY IMAP4rev1] Fake IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            parts = line.decode().strip().split(' ', 2)
+            if len(parts) < 2: continue
+            tag, cmd = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ''
+            self.server.mailbox.stats["commands"] += 1
+            if cmd == 'LOGOUT':
+                self.send("* BYE\r\n" f"{tag} OK LOGOUT completed\r\n")
+                return
+            handler = getattr(self, f"cmd_{cmd.lower()}", None)
+            if handler: handler(tag, args)
+            else: self.send(f"{tag} BAD unknown command\r\n")
+
+    def cmd_capability(self, tag, args):
+        self.send(f"* CAPABILITY IMAP4rev1\r\n{tag} OK CAPABILITY completed\r\n")
+
+    def cmd_noop(self, tag, args):
+        self.send(f"{tag} OK NOOP completed\r\n")
+
+    def cmd_login(self, tag, args):
+        self.send(f"{tag} OK LOGIN completed\r\n")
+
+    def cmd_select(self, tag, args):
+        mb = self.server.mailbox
+        self.send(f"* {len(mb.messages)} EXISTS\r\n* OK [UIDVALIDITY {mb.uidvalidity}] UIDs valid\r\n"
+                  f"* OK [UIDNEXT {mb.next_uid}] Predicted next UID\r\n{tag} OK [READ-WRITE] SELECT completed\r\n")
+
+    def cmd_status(self, tag, args):
+        mb = self.server.mailbox
+        self.send(f"* STATUS INBOX (UIDVALIDITY {mb.uidvalidity} UIDNEXT {mb.next_uid})\r\n{tag} OK STATUS completed\r\n")
+
+    def cmd_close(self, tag, args):
+        self.send(f"{tag} OK CLOSE completed\r\n")
+
+    def cmd_uid(self, tag, args):
+        sub, _, rest = args.partition(' ')
+        sub = sub.upper()
+        with self.server.mailbox.lock:
+            messages = list(self.server.mailbox.messages)
+        max_uid = messages[-1][0] if messages else 0
+        if sub == 'SEARCH':
+            self.send(f"* SEARCH {' '.join(str(u) for u in self.search(messages, max_uid, rest))}\r\n{tag} OK SEARCH completed\r\n")
+        elif sub == 'FETCH':
+            uid_spec, _, items = rest.partition(' ')
+            wanted = parse_uid_set(uid_spec, max_uid)
+            for seq, (uid, raw, msg) in enumerate(messages, 1):
+                if uid in wanted: self.send_fetch(seq, uid, raw, items.upper())
+            self.send(f"{tag} OK FETCH completed\r\n")
+        else:
+            self.send(f"{tag} BAD unsupported UID command\r\n")
+
+    def search(self, messages, max_uid, crit):
+        uid_m = re.search(r'UID ([\d:*,]+)', crit, re.I)
+        since_m = re.search(r'SINCE "?([\w-]+)"?', crit, re.I)
+        from_m = re.search(r'FROM "([^"]*)"', crit, re.I)
+        uid_set = parse_uid_set(uid_m.group(1), max_uid) if uid_m else None
+        since = datetime.strptime(since_m.group(1), "%d-%b-%Y").date() if since_m else None
+        result = []
+        for uid, raw, msg in messages:
+            if uid_set is not None and uid not in uid_set: continue
+            if since and email.utils.parsedate_to_datetime(msg["Date"]).date() < since: continue
+            if from_m and from_m.group(1).lower() not in (msg["From"] or "").lower(): continue
+            result.append(uid)
+        return result
+
+    def send_fetch(self, seq, uid, raw, items):
+        hm = re.search(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', items)
+        if hm:
+            fields = hm.group(1).split()
+            msg = email.message_from_bytes(raw)
+            data = "".join(f"{f.title()}: {msg[f]}\r\n" for f in fields if msg[f] is not None).encode() + b"\r\n"
+            section = f"BODY[HEADER.FIELDS ({hm.group(1)})]"
+        else:
+            data = raw
+            section = "RFC822" if "RFC822" in items else "BODY[]"
+            self.server.mailbox.stats["bodies"] += 1
+        self.send(f"* {seq} FETCH (UID {uid} {section} {{{len(data)}}}\r\n".encode() + data + b")\r\n")
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox=None, port=0):
+        super().__init__(('127.0.0.1', port), IMAPHandler)
+        self.mailbox = mailbox or Mailbox()
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def imap_factory(self, host, port):
+        """Dùng cho EmailMCP(imap_factory=...): bỏ qua host/port cấu hình, nối vào server giả."""
+        return imaplib.IMAP4('127.0.0.1', self.port)
+
+def run(emails, new):
+    import db_manager
+    import email_mcp
+
+    db_manager.DB_FILE = os.path.join(tempfile.mkdtemp(prefix='fake_imap_'), 'test.db')
+    db_manager.init_db()
+    for k, v in {'email_account': 'home@example.com', 'email_password': 'x', 'email_scan_days': 30}.items():
+        db_manager.set_setting(k, v)
+
+    server = FakeIMAPServer()
+    mb = server.mailbox
+    now = datetime.now().astimezone()
+    for i in range(emails):
+        mb.add_email(f"Thông báo số {i}", f"Nội dung {i}", date=now - timedelta(hours=i))
+
+    service = email_mcp.EmailMCP(imap_factory=server.imap_factory)
+
+    def sync(label):
+        before = dict(mb.stats)
+        t = time.perf_counter()
+        service.check_mail()
+        elapsed = (time.perf_counter() - t) * 1000
+        d = {k: mb.stats[k] - before[k] for k in before}
+        print(f"{label}: {elapsed:.0f}ms, {d['commands']} commands, {d['bodies']} bodies, {d['bytes_sent'] / 1024:.0f}KB sent, "
+              f"{len(db_manager.get_emails(limit=100000))} emails in DB")
+
+    sync("first sync")
+    sync("no new mail")
+    for i in range(new):
+        mb.add_email(f"Thông báo phí tháng {i}", "Mới")
+    sync(f"{new} new mails")
+    mb.uidvalidity += 1
+    sync("UIDVALIDITY changed")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake IMAP server for EmailMCP.check_mail")
+    parser.add_argument('--emails', type=int, default=300)
+    parser.add_argument('--new', type=int, default=5)
+    args = parser.parse_args()
+    run(args.emails, args.new)
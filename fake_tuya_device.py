@@ -0,0 +1,231 @@
+# FILE: fake_tuya_device.py
+"""
+Thiết bị Tuya giả lập (giao thức 3.3) chạy trên localhost.
+
+Dùng để thử và đo tốc độ tuya_async.AsyncTuyaClient mà không cần thiết bị thật.
+
+Usage:
+    python fake_tuya_device.py --bench 200            # So sánh asyncio vs tinytuya tuần tự
+    python fake_tuya_device.py --bench 200 --delay 0.05
+    python fake_tuya_device.py --bench-pool 200 --connect-delay 0.1   # Lệnh MCP: kết nối mới mỗi lần vs DevicePool
+"""
+import asyncio
+import argparse
+import json
+import struct
+import threading
+import time
+import tinytuya
+
+VERSION_HEADER = b"3.3" + b"\x00" * 12
+
+class FakeTuyaDevice:
+    """1 thiết bị giả: trả lời DP_QUERY, CONTROL, HEART_BEAT và có thể tự đẩy trạng thái."""
+
+    def __init__(self, dev_id, key, port, dps=None, delay=0.0, push_interval=None, children=None, connect_delay=0.0):
+        self.dev_id = dev_id
+        self.children = children or {}      # Giả lập Gateway: cid -> dps của thiết bị con
+        self.key = key
+        self.port = port
+        self.dps = dps if dps is not None else {"1": False, "2": 0}
+        self.delay = delay                  # Giả lập thiết bị phản hồi chậm
+        self.connect_delay = connect_delay  # Giả lập chi phí kết nối mới (WiFi + bắt tay session key 3.4/3.5)
+        self.connections = 0
+        self.push_interval = push_interval  # Giây giữa 2 lần tự đẩy trạng thái (None = tắt)
+        self.cipher = tinytuya.AESCipher(key.encode('latin1'))
+        self.server = None
+        self.seqno = 1
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1'):
+        self.server = await asyncio.start_server(self.handle_client, host, self.port)
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def encrypt(self, data, with_header=False):
+        raw = self.cipher.encrypt(json.dumps(data).encode(), False)
+        return VERSION_HEADER + raw if with_header else raw
+
+    def decrypt(self, payload):
+        if payload.startswith(VERSION_HEADER[:3]):
+            payload = payload[len(VERSION_HEADER):]
+        if not payload: return {}
+        return json.loads(self.cipher.decrypt(payload, False, decode_text=False))
+
+    def frame(self, cmd, payload=b"", seqno=None):
+        if seqno is None:
+            seqno = self.seqno
+            self.seqno += 1
+        body = struct.pack(">I", 0) + payload
+        msg = tinytuya.TuyaMessage(seqno, cmd, 0, body, 0, True, tinytuya.PREFIX_55AA_VALUE, None)
+        return tinytuya.pack_message(msg)
+
+    async def read_frame(self, reader):
+        data = await reader.readexactly(16)
+        header = tinytuya.parse_header(data)
+        data += await reader.readexactly(header.total_length - len(data))
+        return tinytuya.unpack_message(data, header=header, no_retcode=True)
+
+    async def push_loop(self, writer):
+        while True:
+            await asyncio.sleep(self.push_interval)
+            self.dps["2"] = int(self.dps.get("2", 0)) + 1
+            writer.write(self.frame(tinytuya.STATUS, self.encrypt({"dps": {"2": self.dps["2"]}, "t": int(time.time())}, True)))
+            await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        self.connections += 1
+        if self.connect_delay: await asyncio.sleep(self.connect_delay)
+        pusher = asyncio.ensure_future(self.push_loop(writer)) if self.push_interval else None
+        try:
+            while True:
+                msg = await self.read_frame(reader)
+                self.requests += 1
+                if self.delay: await asyncio.sleep(self.delay)
+
+                if msg.cmd == tinytuya.DP_QUERY:
+                    cid = self.decrypt(msg.payload).get("cid")
+                    if cid in self.children:
+                        reply = {"cid": cid, "dps": self.children[cid], "t": int(time.time())}
+                    else:
+                        reply = {"devId": self.dev_id, "dps": self.dps, "t": int(time.time())}
+                    writer.write(self.frame(msg.cmd, self.encrypt(reply), msg.seqno))
+                elif msg.cmd == tinytuya.CONTROL:
+                    request = self.decrypt(msg.payload)
+                    changed = request.get("dps", {})
+                    cid = request.get("cid")
+                    target = self.children[cid] if cid in self.children else self.dps
+                    target.update(changed)
+                    writer.write(self.frame(msg.cmd, b"", msg.seqno))
+                    report = {"dps": changed, "t": int(time.time())}
+                    if cid in self.children: report["cid"] = cid
+                    writer.write(self.frame(tinytuya.STATUS, self.encrypt(report, True)))
+                elif msg.cmd == tinytuya.HEART_BEAT:
+                    writer.write(self.frame(msg.cmd, b"", msg.seqno))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if pusher: pusher.cancel()
+            writer.close()
+
+async def start_fleet(count, base_port=16668, delay=0.0, push_interval=None):
+    devices = []
+    for i in range(count):
+        dev = FakeTuyaDevice(f"fake{i:06d}", "0123456789abcdef", base_port + i, delay=delay, push_interval=push_interval)
+        devices.append(await dev.start())
+    return devices
+
+def bench(count, delay):
+    import tuya_async
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    fleet = asyncio.run_coroutine_threadsafe(start_fleet(count, delay=delay), loop).result()
+
+    # 1. tinytuya tuần tự (cách background_polling cũ làm)
+    objs = []
+    for dev in fleet:
+        d = tinytuya.OutletDevice(dev.dev_id, '127.0.0.1', dev.key, version=3.3, port=dev.port)
+        d.set_socketPersistent(True)
+        d.set_socketTimeout(2)
+        objs.append(d)
+    for d in objs: d.status()  # mở socket trước
+    t = time.time()
+    ok = sum(1 for d in objs if 'dps' in (d.status() or {}))
+    print(f"tinytuya sequential : {count} devices, {ok} ok, {time.time() - t:.3f}s")
+
+    # 2. asyncio client (1 event loop)
+    client = tuya_async.AsyncTuyaClient(timeout=2.0).start()
+    for dev in fleet:
+        client.register(dev.dev_id, '127.0.0.1', dev.key, 3.3, port=dev.port)
+    ids = [dev.dev_id for dev in fleet]
+    client.status_many(ids)  # mở socket trước
+    t = time.time()
+    results = client.status_many(ids)
+    ok = sum(1 for r in results.values() if r and 'dps' in r)
+    print(f"asyncio status_many : {count} devices, {ok} ok, {time.time() - t:.3f}s")
+    client.close()
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+def bench_pool(commands, delay, connect_delay):
+    """Độ trễ lệnh kiểu MCP (bật/tắt + hỏi trạng thái) tới 1 ổ cắm WiFi và 2 thiết bị con của 1 Gateway."""
+    import os
+    import tempfile
+    import db_manager
+    db_manager.DB_FILE = os.path.join(tempfile.mkdtemp(prefix='bench_pool_'), 'bench.db')
+    db_manager.init_db()
+    import tuya_mcp
+    from device_pool import DevicePool
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    key = "0123456789abcdef"
+    plug = FakeTuyaDevice("fakeplug0001", key, 16700, delay=delay, connect_delay=connect_delay)
+    gw = FakeTuyaDevice("fakegw000001", key, 16701, delay=delay, connect_delay=connect_delay,
+                        children={"node1": {"1": False}, "node2": {"1": False}})
+    for dev in (plug, gw):
+        asyncio.run_coroutine_threadsafe(dev.start(), loop).result()
+
+    targets = [
+        {'id': plug.dev_id, 'ip': '127.0.0.1', 'key': key, 'version': 3.3, 'port': plug.port},
+        {'id': 'child1', 'ip': '127.0.0.1', 'key': key, 'version': 3.3, 'port': gw.port,
+         'is_sub': True, 'parent': gw.dev_id, 'node_id': 'node1'},
+        {'id': 'child2', 'ip': '127.0.0.1', 'key': key, 'version': 3.3, 'port': gw.port,
+         'is_sub': True, 'parent': gw.dev_id, 'node_id': 'node2'},
+    ]
+
+    def command(d, n):
+        if n % 2: d.set_value("1", n % 4 == 1)
+        else: d.status()
+
+    def run(label, one_command):
+        before = plug.connections + gw.connections
+        latencies = []
+        for n in range(commands):
+            t = time.perf_counter()
+            one_command(targets[n % len(targets)], n)
+            latencies.append(time.perf_counter() - t)
+        print(f"{label:<22}: {commands} commands, p50 {percentile(latencies, 0.5):.1f}ms, "
+              f"p99 {percentile(latencies, 0.99):.1f}ms, {plug.connections + gw.connections - before} TCP connects")
+
+    def fresh(dev_info, n):
+        d, err = tuya_mcp.get_tuya_obj(dev_info)
+        command(d, n)
+        d.close()
+
+    pool = DevicePool()
+    def pooled(dev_info, n):
+        with pool.session(dev_info) as d:
+            command(d, n)
+
+    run("new connection / cmd", fresh)
+    run("DevicePool", pooled)
+    print(f"pool stats: {pool.stats}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake Tuya 3.3 devices")
+    parser.add_argument('--bench', type=int, default=0, help="Số thiết bị giả để benchmark")
+    parser.add_argument('--delay', type=float, default=0.0, help="Độ trễ phản hồi mỗi lệnh (giây)")
+    parser.add_argument('--serve', type=int, default=0, help="Chỉ chạy N thiết bị giả (port 16668+)")
+    parser.add_argument('--bench-pool', type=int, default=0, help="Số lệnh MCP để so sánh kết nối mới vs DevicePool")
+    parser.add_argument('--connect-delay', type=float, default=0.0, help="Chi phí mỗi kết nối mới (giây)")
+    args = parser.parse_args()
+
+    if args.bench_pool:
+        bench_pool(args.bench_pool, args.delay, args.connect_delay)
+    elif args.bench:
+        bench(args.bench, args.delay)
+    elif args.serve:
+        async def serve():
+            fleet = await start_fleet(args.serve, delay=args.delay, push_interval=5)
+            print(f"Serving {len(fleet)} fake devices on 127.0.0.1:{fleet[0].port}-{fleet[-1].port}")
+            await asyncio.Event().wait()
+        asyncio.run(serve())
@@ -1,28 +1,78 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory
 import tinytuya
+import copy
 import json
 import time
 import os
 import threading
 import sys
-import io
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # FORCE UTF-8 ENCODING FOR WINDOWS
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+# reconfigure thay vì bọc TextIOWrapper mới: master_mcp import main, wrapper cũ bị thu hồi sẽ đóng luôn stdout
+sys.stdout.reconfigure(encoding='utf-8')
+sys.stderr.reconfigure(encoding='utf-8')
 
 from datetime import datetime, timedelta
 import db_manager # <--- MỚI: Module quản lý DB
+from polling_engine import PollingEngine
+from poll_scheduler import PollScheduler
+from timer_scheduler import TimerScheduler
+from event_hub import EventHub
+import tuya_async
+import tuya_dps
 
 app = Flask(__name__)
 
 # Cache lưu trạng thái thiết bị (Vẫn giữ Cache trên RAM để phản hồi nhanh)
 tuya_cache = {}
-active_timers = {}
 
 # Lock để tránh xung đột
 data_lock = threading.Lock()
 
+# Version của Cache: tăng mỗi khi 1 thiết bị đổi dps/online/timer/config (info['rev'] = version lúc đổi).
+# Bắt đầu từ thời điểm khởi động (ms) để version sau khi restart luôn lớn hơn version cũ của client.
+BOOT_VERSION = int(time.time() * 1000)
+state_version = BOOT_VERSION
+version_lock = threading.Lock()
+dirty_devices = set()   # Thiết bị đổi từ lần dựng snapshot trước (giữ bởi version_lock)
+
+# Live stream (/api/stream): 1 luồng broadcast gom thay đổi rồi phát tới mọi tablet đang mở
+event_hub = EventHub(max_queue=64)  # Client tồn quá 64 bản tin bị loại, tự kết nối lại
+state_changed = threading.Event()
+STREAM_DEBOUNCE = 0.1    # Giây gom các thay đổi liên tiếp vào 1 bản tin
+STREAM_KEEPALIVE = 15    # Giây giữa 2 lần ping giữ kết nối
+TIMER_REFRESH = 5        # Giây giữa 2 lần cập nhật số phút hẹn giờ trong snapshot
+
+# Snapshot JSON dựng sẵn cho /api/devices và /api/stream. Object bất biến, luồng dựng
+# snapshot thay cả object 1 lần -> người đọc lấy bytes mà không cần data_lock.
+Fragment = namedtuple('Fragment', 'rev timers body')   # JSON (bytes) của 1 thiết bị
+Snapshot = namedtuple('Snapshot', 'version etag fragments timer_devices')
+snapshot = Snapshot(BOOT_VERSION, f'"{BOOT_VERSION}-0"', {}, frozenset())
+
+# Lịch poll thích ứng theo từng thiết bị
+poll_scheduler = PollScheduler()
+
+# Cấu hình polling (chu kỳ từng loại thiết bị nằm trong poll_scheduler.TYPE_PROFILES)
+POLL_TICK = 1       # Giây ngủ tối đa giữa 2 lần kiểm tra lịch poll
+POLL_WORKERS = 8    # Số luồng poll song song mặc định
+GATEWAY_BATCH_TIMEOUT = 3  # Giây chờ tối đa để gom phản hồi của các thiết bị con 1 Gateway
+
+# Backend kết nối: 'tinytuya' (mỗi socket 1 luồng) hoặc 'asyncio' (tuya_async, 1 event loop)
+# Chỉnh trong bảng settings (key: tuya_backend)
+async_client = None
+
+# Chế độ push (settings key: push_mode = '1'): giữ socket mở, nhận trạng thái thiết bị tự đẩy lên.
+# Luôn chạy trên backend asyncio.
+PUSH_HEARTBEAT_INTERVAL = 10
+push_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tuya-push')
+
+# Lệnh điều khiển nhiều thiết bị (/api/control/batch): mỗi kết nối (IP) 1 luồng
+CONTROL_BATCH_WORKERS = 8
+control_executor = ThreadPoolExecutor(max_workers=CONTROL_BATCH_WORKERS, thread_name_prefix='tuya-control')
+
 def safe_float_version(val):
     try: return float(val)
     except: return 0.0
@@ -39,14 +89,26 @@ def get_default_info(did):
         "version": 0.0,
         "via": None,
         "is_sub": False,
+        "gateway_id": None,
         "obj": None,
         "dps": {},
         "online": False,
         "missing_ip": True,
         "snapshot_ver": 0.0,
-        "last_update": 0
+        "last_update": 0,
+        "rev": 0
     }
 
+def mark_changed(dev_id):
+    """Đánh dấu thiết bị vừa thay đổi (gọi SAU khi đã sửa Cache) cho /api/devices?since=."""
+    global state_version
+    with version_lock:
+        state_version += 1
+        info = tuya_cache.get(dev_id)
+        if info: info['rev'] = state_version
+        dirty_devices.add(dev_id)
+    state_changed.set()
+
 def determine_device_type(dev_config):
     cat = dev_config.get('category', '').lower()
     mapping = str(dev_config.get('mapping', {})).lower()
@@ -76,55 +138,95 @@ def init_device(dev, parent=None):
         key = dev_key
         ver = config_ver if config_ver > 0 else 3.3
 
-    if dev_id not in tuya_cache:
-        tuya_cache[dev_id] = get_default_info(dev_id)
+    # Thông tin mới được dựng riêng rồi mới gán vào Cache (1 lần, trong data_lock),
+    # nên luồng poll không bao giờ thấy thiết bị ở trạng thái cập nhật dở.
+    info = tuya_cache.get(dev_id)
+    is_new = info is None
+    if is_new: info = get_default_info(dev_id)
+    missing_ip = not ip or ip == "0.0.0.0"
 
     # Cập nhật thông tin static từ DB vào Cache
-    tuya_cache[dev_id].update({
+    static = {
         "name": dev.get('name', 'Unknown'),
         "type": determine_device_type(dev),
         "category": dev.get('category', ''),
         "mapping": dev.get('mapping', {}),
-        "ip": ip if ip and ip != "0.0.0.0" else None,
+        "ip": None if missing_ip else ip,
         "real_ip": dev.get('ip', ''), # IP lưu trong config chính chủ
         "version": ver,
         "via": parent.get('name') if parent else None,
         "is_sub": True if parent else False,
-        "missing_ip": False
-    })
-
-    # Restore trạng thái cũ từ DB (nếu có) để UI không bị trống lúc mới khởi động
-    if 'dps' in dev and dev['dps']:
-        tuya_cache[dev_id]['dps'].update(dev['dps'])
+        "gateway_id": parent.get('id') if parent else None,
+        "missing_ip": missing_ip
+    }
+    changed = is_new or any(info.get(k) != v for k, v in static.items())
+
+    old_obj = d = info.get("obj")
+    if not missing_ip:
+        try:
+            dev_class = tinytuya.BulbDevice if static['type'] == 'light' else tinytuya.OutletDevice
+            node_id = dev.get('node_id', dev_id)
+
+            # Thiết bị con Zigbee dùng chung socket của object Gateway (tinytuya parent/child)
+            gw_obj = None
+            if parent:
+                gw_info = tuya_cache.get(parent.get('id'))
+                gw_obj = gw_info.get('obj') if gw_info else None
+
+            # Chỉ tạo lại object khi thông tin kết nối thật sự đổi (đổi tên thì giữ nguyên socket)
+            if d is not None and type(d) is not dev_class:
+                d = None
+            elif d is not None and gw_obj is not None:
+                if d.parent is not gw_obj or d.cid != node_id: d = None  # Đổi Gateway -> tạo lại object con
+            elif d is not None:
+                if (d.parent is not None or d.address != ip or d.real_local_key != (key or '').encode('latin1')
+                        or d.version != ver or (parent and d.cid != node_id)):
+                    d = None
+
+            if d is None and gw_obj is not None:
+                d = dev_class(dev_id, cid=node_id, parent=gw_obj)
+            elif d is None:
+                d = dev_class(dev_id, ip, key)
+                
+                d.set_version(ver)
+                d.set_socketPersistent(True) 
+                d.set_socketRetryLimit(1)
+                d.set_socketTimeout(2)
+                if parent: d.cid = node_id
+        except: d = old_obj
 
-    if not ip or ip == "0.0.0.0":
-        tuya_cache[dev_id]["missing_ip"] = True
+    with data_lock:
+        info.update(static)
+        info["obj"] = d
+        # Restore trạng thái cũ từ DB (nếu có) để UI không bị trống lúc mới khởi động
+        if is_new and dev.get('dps'):
+            info['dps'].update(dev['dps'])
+        if is_new: tuya_cache[dev_id] = info
+
+    if changed: mark_changed(dev_id)
+
+    # Đóng socket cũ sau khi đã đổi sang object mới (chờ worker đang dùng socket đó xong)
+    if old_obj is not None and old_obj is not d and old_obj.parent is None:
+        with poll_engine.ip_lock(old_obj.address):
+            try: old_obj.close()
+            except: pass
+
+    if missing_ip:
+        poll_scheduler.remove(dev_id)
+        if async_client: async_client.unregister(dev_id)
         return
 
-    try:
-        # Tái sử dụng object connection
-        if not tuya_cache[dev_id].get("obj"):
-            if tuya_cache[dev_id]['type'] == 'light':
-                d = tinytuya.BulbDevice(dev_id, ip, key)
-            else:
-                d = tinytuya.OutletDevice(dev_id, ip, key)
-            
-            d.set_version(ver)
-            d.set_socketPersistent(True) 
-            d.set_socketRetryLimit(1)
-            d.set_socketTimeout(2)
-            if parent: d.cid = dev.get('node_id', dev_id)
-            
-            tuya_cache[dev_id]["obj"] = d
-        else:
-            # Update lại thông tin kết nối nếu config đổi
-            d = tuya_cache[dev_id]["obj"]
-            d.set_version(ver)
-            d.address = ip
-            d.local_key = key
-            if parent: d.cid = dev.get('node_id', dev_id)
+    poll_scheduler.add(dev_id, static['type'])
 
-    except: pass
+    if async_client and d is not None:
+        # Object tinytuya ở trên chỉ còn là fallback cho thiết bị asyncio không xử lý được
+        async_client.register(dev_id, ip, key, ver,
+                              cid=dev.get('node_id', dev_id) if parent else None,
+                              gateway_id=parent.get('id') if parent else None,
+                              fallback=d)
+
+def is_gateway(dev):
+    return 'wg' in dev.get('category', '') or bool(dev.get('ip') and not dev.get('parent'))
 
 def load_system():
     print("--> Đang nạp danh sách thiết bị từ SQLite...")
@@ -133,9 +235,10 @@ def load_system():
     all_devices = db_manager.get_all_devices()
     
     # 2. Lọc ra Gateway để xử lý thiết bị con
-    gateways = {d['id']: d for d in all_devices if 'wg' in d.get('category', '') or (d.get('ip') and not d.get('parent'))}
+    gateways = {d['id']: d for d in all_devices if is_gateway(d)}
 
-    # 3. Khởi tạo từng thiết bị
+    # 3. Khởi tạo từng thiết bị (Gateway trước để thiết bị con gắn được vào socket của cha)
+    all_devices.sort(key=lambda d: 1 if d.get('parent') in gateways else 0)
     for dev in all_devices:
         parent = None
         pid = dev.get('parent')
@@ -144,145 +247,567 @@ def load_system():
         
     print(f"--> Đã nạp {len(tuya_cache)} thiết bị từ DB.")
 
+def reload_device(dev_id):
+    """
+    Nạp lại 1 thiết bị từ DB sau khi sửa config (thay cho load_system() toàn bộ).
+    Nếu là Gateway thì nạp lại cả các thiết bị con (IP/key của con lấy từ Gateway).
+    """
+    dev = db_manager.get_device(dev_id)
+    if not dev: return
+
+    parent = None
+    pid = dev.get('parent')
+    if pid:
+        gw = db_manager.get_device(pid)
+        if gw and is_gateway(gw): parent = gw
+    init_device(dev, parent)
+
+    if is_gateway(dev):
+        for child in db_manager.get_children(dev_id):
+            init_device(child, dev)
+
+# --- GỬI LỆNH / ĐỌC TRẠNG THÁI QUA BACKEND ĐANG DÙNG ---
+def device_status(dev_id, info):
+    if async_client: return async_client.status(dev_id)
+    return info['obj'].status()
+
+def device_set_values(dev_id, info, dps):
+    """Ghi nhiều DP trong 1 frame CONTROL (1 round-trip)."""
+    if async_client: return async_client.set_multiple_values(dev_id, dps)
+    return info['obj'].set_multiple_values(dps)
+
+def get_cached_state(dev_id):
+    """Trạng thái poll gần nhất {'dps', 'online', 'last_update'} (cho MCP check_status), None nếu không có."""
+    info = tuya_cache.get(dev_id)
+    if not info: return None
+    with data_lock:
+        return {"dps": dict(info['dps']), "online": info.get('online', False), "last_update": info.get('last_update') or 0}
+
+# --- CHO MCP CHẠY CHUNG PROCESS (master_mcp): dùng chung socket + làn IP với poller ---
+def read_device(dev_id):
+    """Đọc trực tiếp trạng thái thiết bị rồi cập nhật Cache + DB. Trả về data có 'dps', None = Offline."""
+    info = tuya_cache.get(dev_id)
+    if not info or not info.get('obj'): raise RuntimeError("Chưa có kết nối")
+    with poll_engine.ip_lock(info.get('ip')):
+        try: data = device_status(dev_id, info)
+        except: data = None
+    return apply_status(dev_id, data)
+
+def write_device(dev_id, dps):
+    """Ghi {dp: value} trong 1 frame (xem set_device_dps). Lỗi -> raise."""
+    info = tuya_cache.get(dev_id)
+    if not info or not info.get('obj'): raise RuntimeError("Chưa có kết nối")
+    poll_scheduler.mark_active(dev_id)
+    try:
+        set_device_dps(dev_id, info, dps)
+    finally:
+        mark_changed(dev_id)
+
+# --- HẸN GIỜ (TimerScheduler gọi execute_timer đúng thời điểm) ---
+def execute_timer(dev_id, dp_id, action):
+    print(f"⏰ Timer kích hoạt: {dev_id} (DP {dp_id or 'None'}) -> {action}")
+
+    info = tuya_cache.get(dev_id)
+    if not info or not info.get('obj'):
+        print(f"⚠️ Bỏ qua timer {dev_id}: thiết bị chưa có kết nối")
+        mark_changed(dev_id)  # Timer đã hết -> UI cần bỏ đồng hồ đếm ngược
+        return
+    is_on = (action == 'on')
+    poll_scheduler.mark_active(dev_id)
+
+    try:
+        switch_device(dev_id, info, dp_id, is_on)
+    finally:
+        mark_changed(dev_id)
+
+def switch_device(dev_id, info, dp_id, is_on):
+    """Bật/Tắt 1 DP, hoặc mọi DP công tắc của thiết bị nếu dp_id rỗng (vẫn chỉ 1 frame)."""
+    if dp_id: dp_ids = [str(dp_id)]
+    else: dp_ids = tuya_dps.switch_dps(info.get('mapping'), info.get('dps'), info.get('type') == 'light')
+    set_device_dps(dev_id, info, {k: is_on for k in dp_ids})
+
+def set_device_dps(dev_id, info, dps):
+    """Ghi {dp: value} trong 1 frame rồi cập nhật Cache + DB + lịch sử 1 lần."""
+    dps = {str(k): v for k, v in dps.items()}
+    if not dps: return
+    with poll_engine.ip_lock(info.get('ip')):
+        result = device_set_values(dev_id, info, dps)
+        if isinstance(result, dict) and result.get('Error'):
+            raise RuntimeError(result['Error'])
+
+        with data_lock:
+            changes = {k: v for k, v in dps.items() if info['dps'].get(k) != v}
+            info['dps'].update(changes)
+            # Cập nhật DB (poll lần sau sẽ không thấy thay đổi nên lịch sử ghi ở đây)
+            db_manager.update_device_state(dev_id, changes)
+            db_manager.record_history(dev_id, changes)
+
+def control_batch(targets):
+    """
+    Bật/Tắt nhiều thiết bị/DP: targets = [{"id", "dps_id" (tùy chọn), "action": "on"/"off"}]
+    hoặc ghi nhiều DP 1 lần: [{"id", "dps": {"1": true, "2": false}}].
+    Gom theo kết nối vật lý (IP = 1 Gateway hoặc 1 thiết bị WiFi): các nhóm chạy song song,
+    trong 1 nhóm chạy lần lượt (chung socket). Kết quả theo đúng thứ tự targets.
+    """
+    results = [None] * len(targets)
+    groups = {}
+    for i, t in enumerate(targets):
+        dev_id = t.get('id')
+        info = tuya_cache.get(dev_id)
+        if not t.get('dps') and t.get('action') not in ('on', 'off'):
+            results[i] = {"id": dev_id, "success": False, "message": "action phải là 'on' hoặc 'off'"}
+        elif t.get('dps') is not None and not isinstance(t['dps'], dict):
+            results[i] = {"id": dev_id, "success": False, "message": "dps phải là object {dp: value}"}
+        elif not info or not info.get('obj'):
+            results[i] = {"id": dev_id, "success": False, "message": "Chưa có kết nối"}
+        else:
+            groups.setdefault(info.get('ip'), []).append(i)
+
+    def run_group(indexes):
+        for i in indexes:
+            t = targets[i]
+            dev_id = t['id']
+            poll_scheduler.mark_active(dev_id)
+            try:
+                if t.get('dps'): set_device_dps(dev_id, tuya_cache[dev_id], t['dps'])
+                else: switch_device(dev_id, tuya_cache[dev_id], t.get('dps_id'), t['action'] == 'on')
+                results[i] = {"id": dev_id, "dps_id": t.get('dps_id'), "success": True}
+            except Exception as e:
+                results[i] = {"id": dev_id, "dps_id": t.get('dps_id'), "success": False, "message": str(e)}
+            finally:
+                mark_changed(dev_id)
+
+    for f in [control_executor.submit(run_group, indexes) for indexes in groups.values()]:
+        f.result()
+    return results
+
+timer_scheduler = TimerScheduler(execute_timer)
+
+def set_device_timer(dev_id, dp_id, minutes):
+    """
+    Đặt/Hủy hẹn giờ (dùng chung cho Web API và MCP tool).
+    Hành động là đảo trạng thái hiện tại: Đang Bật -> Hẹn Tắt, Đang Tắt -> Hẹn Bật.
+    minutes <= 0: hủy hẹn giờ.
+    Returns: dict {success, cancelled, action, message}
+    """
+    dp_id = TimerScheduler.normalize_dp(dp_id)
+
+    if minutes <= 0:
+        cancelled = timer_scheduler.cancel(dev_id, dp_id)
+        if cancelled: mark_changed(dev_id)
+        return {"success": True, "cancelled": cancelled, "action": None, "message": "Đã hủy hẹn giờ."}
+
+    info = tuya_cache.get(dev_id)
+    if not info:
+        return {"success": False, "cancelled": False, "action": None, "message": "Không tìm thấy thiết bị."}
+
+    dps = info.get('dps', {})
+    if dp_id and dp_id in dps:
+        is_currently_on = dps[dp_id]
+    else:
+        is_currently_on = dps.get('1') or dps.get('20') or False
+
+    action = 'off' if is_currently_on else 'on'
+    timer_scheduler.add(dev_id, dp_id, action, datetime.now() + timedelta(minutes=minutes))
+    mark_changed(dev_id)
+
+    action_vn = "TẮT" if action == 'off' else "BẬT"
+    target_name = info['name']
+    if dp_id and 'mapping' in info and dp_id in info['mapping']:
+        target_name += " (" + info['mapping'][dp_id].get('name', dp_id) + ")"
+    return {"success": True, "cancelled": False, "action": action,
+            "message": f"Sẽ {action_vn} {target_name} sau {minutes} phút."}
+
 # --- LUỒNG CẬP NHẬT TRẠNG THÁI (POLLING THREAD) ---
+def apply_status(dev_id, data, pushed=False):
+    """
+    Ghi kết quả status() của 1 thiết bị vào Cache (và DB nếu có thay đổi).
+    pushed=True: bản tin thiết bị tự đẩy (có thể chỉ vài DP) -> không dời lịch poll.
+    """
+    info = tuya_cache.get(dev_id)
+    if not info:
+        return None
+    
+    result = None
+    is_changed = False
+    try:
+        if data and 'dps' in data:
+            is_changed = False
+            with data_lock:
+                # Kiểm tra xem có gì mới không
+                old_dps = info.get('dps', {})
+                new_dps = data['dps']
+                
+                # Các DP đổi giá trị (ghi vào lịch sử)
+                changes = {str(k): v for k, v in new_dps.items() if str(k) not in old_dps or old_dps[str(k)] != v}
+
+                # Chỉ update DB nếu có thay đổi giá trị hoặc thiết bị vừa online lại
+                is_changed = bool(changes) or info.get('online') == False
+                
+                info['dps'].update(new_dps)
+                info['online'] = True
+                info['last_update'] = time.time()
+            
+            if changes:
+                db_manager.record_history(dev_id, changes, info['last_update'])
+            if is_changed:
+                mark_changed(dev_id)
+                # Ghi xuống DB chỉ các DP vừa đổi (1 DP đổi = 1 row), {} nếu chỉ vừa online lại
+                # Chạy trong worker của polling engine nên không lo block UI chính
+                db_manager.update_device_state(dev_id, changes, is_online=True)
+            result = data
+                
+        elif 'Error' in str(data):
+            if info.get('online'):
+                info['online'] = False
+                mark_changed(dev_id)
+                db_manager.update_device_state(dev_id, {}, is_online=False)
+    except:
+        if info.get('online'):
+            info['online'] = False
+            mark_changed(dev_id)
+
+    # Báo cho lịch poll để tăng/giảm tần suất của thiết bị này
+    if pushed and result is not None:
+        poll_scheduler.record_push(dev_id, changed=is_changed)
+    else:
+        poll_scheduler.record_result(dev_id, online=result is not None, changed=is_changed)
+    return result
+
+def poll_device(dev_id):
+    """Đọc trạng thái 1 thiết bị. Được gọi từ worker của PollingEngine."""
+    info = tuya_cache.get(dev_id)
+    if not info or info.get('missing_ip') or not info.get('obj'):
+        return None
+    
+    try:
+        data = device_status(dev_id, info)
+    except:
+        if info.get('online'):
+            info['online'] = False
+            mark_changed(dev_id)
+        data = None
+    return apply_status(dev_id, data)
+
+# --- LỊCH SỬ DP: gộp phút/giờ/ngày + xoá theo retention ---
+HISTORY_ROLLUP_INTERVAL = 60
+HISTORY_PRUNE_INTERVAL = 3600
+
+def history_jobs():
+    last_prune = 0
+    while True:
+        time.sleep(HISTORY_ROLLUP_INTERVAL)
+        try:
+            db_manager.rollup_history()
+            if time.time() - last_prune >= HISTORY_PRUNE_INTERVAL:
+                db_manager.prune_history()
+                last_prune = time.time()
+        except Exception as e:
+            print(f"Lỗi rollup lịch sử: {e}")
+
+# --- CHẾ ĐỘ PUSH ---
+def on_device_push(dev_id, data):
+    # Được gọi trong event loop -> chuyển sang luồng riêng để không chặn socket khác khi ghi DB
+    push_executor.submit(handle_push, dev_id, data)
+
+def handle_push(dev_id, data):
+    # Thiết bị đã tự đẩy trạng thái -> chỉ cần poll đối chiếu thưa (lịch poll không bị dời)
+    apply_status(dev_id, data, pushed=True)
+
+def on_link_change(dev_ids, online):
+    push_executor.submit(handle_link_change, dev_ids, online)
+
+def handle_link_change(dev_ids, online):
+    for dev_id in dev_ids:
+        if online:
+            # Vừa kết nối (lại): poll ngay 1 lần để lấy đủ trạng thái
+            poll_scheduler.poll_now(dev_id)
+        else:
+            # Mất socket -> quay về poll thường cho tới khi thiết bị đẩy lại
+            poll_scheduler.set_push(dev_id, False)
+            apply_status(dev_id, tinytuya.error_json(tinytuya.ERR_OFFLINE))
+
+def poll_gateway_children(child_ids):
+    """
+    Poll các thiết bị con Zigbee theo lô: gửi DP_QUERY của mọi thiết bị con liên tiếp
+    qua 1 socket Gateway (không chờ), sau đó gom các phản hồi và phân phát về Cache
+    theo cid. Số lượt khứ hồi tới Gateway gần như không phụ thuộc số thiết bị con.
+    """
+    groups = {}
+    for dev_id in child_ids:
+        obj = tuya_cache[dev_id]['obj']
+        groups.setdefault(obj.parent, []).append(dev_id)
+
+    results = {}
+    for gw_obj, ids in groups.items():
+        pending = set()
+        for dev_id in ids:
+            err = tuya_cache[dev_id]['obj'].status(nowait=True)
+            if err and 'Error' in str(err):
+                # Không gửi được tới Gateway -> cả nhóm coi như offline
+                for did in ids: results[did] = apply_status(did, err)
+                pending = set()
+                break
+            pending.add(dev_id)
+
+        deadline = time.time() + GATEWAY_BATCH_TIMEOUT
+        while pending and time.time() < deadline:
+            data = gw_obj.receive()
+            if not data: break
+            child = data.get('device')
+            dev_id = child.id if child is not None else None
+            if dev_id in tuya_cache:
+                # Bản tin của thiết bị con khác (tự đẩy lên) cũng được ghi nhận luôn
+                results[dev_id] = apply_status(dev_id, data)
+                pending.discard(dev_id)
+
+        for dev_id in pending:
+            results[dev_id] = apply_status(dev_id, tinytuya.error_json(tinytuya.ERR_TIMEOUT))
+    return results
+
+def poll_lane(ip, dev_ids):
+    """Poll 1 làn (cùng IP): thiết bị thường poll lần lượt, thiết bị con Gateway poll theo lô."""
+    results = {}
+    children = []
+    for dev_id in dev_ids:
+        obj = (tuya_cache.get(dev_id) or {}).get('obj')
+        if obj is not None and obj.parent is not None:
+            children.append(dev_id)
+        else:
+            results[dev_id] = poll_device(dev_id)
+    if children:
+        results.update(poll_gateway_children(children))
+    return results
+
+# Engine poll song song (1 làn / IP để không dùng chung socket)
+poll_engine = PollingEngine(poll_device, max_workers=POLL_WORKERS, lane_func=poll_lane)
+
 def background_polling():
+    global async_client
+    push_mode = db_manager.get_setting('push_mode', False, bool)
+    if push_mode or db_manager.get_setting('tuya_backend', 'tinytuya') == 'asyncio':
+        async_client = tuya_async.AsyncTuyaClient(timeout=2).start()
+        if push_mode:
+            async_client.on_push = on_device_push
+            async_client.on_link = on_link_change
+
     # Load lần đầu
     load_system()
+    # Nạp lại các hẹn giờ còn hạn từ DB (bảng timers) sau khi Cache đã có thiết bị:
+    # timer đến hạn lúc tắt máy sẽ chạy ngay, cần tuya_cache để gửi lệnh
+    timer_scheduler.start()
+
+    if push_mode:
+        async_client.start_monitor(PUSH_HEARTBEAT_INTERVAL)
+
+    # Số luồng poll song song có thể chỉnh trong bảng settings (key: poll_workers)
+    workers = db_manager.get_setting('poll_workers', POLL_WORKERS, int)
+    poll_engine.configure(workers)
     
     while True:
-        now = datetime.now()
-        
-        # 1. XỬ LÝ HẸN GIỜ (Giữ nguyên logic cũ)
-        for key, timer in list(active_timers.items()):
-            if now >= timer['end_time']:
-                try:
-                    parts = key.rsplit('_', 1) 
-                    did = parts[0]
-                    dp_id = parts[1] if len(parts) > 1 else None
-
-                    print(f"⏰ Timer kích hoạt: {did} (DP {dp_id}) -> {timer['action']}")
-                    
-                    info = tuya_cache.get(did)
-                    if info and info.get('obj'):
-                        dev_obj = info['obj']
-                        is_on = (timer['action'] == 'on')
-                        
-                        if dp_id and dp_id != 'None':
-                            dev_obj.set_value(str(dp_id), is_on)
-                            with data_lock:
-                                info['dps'][str(dp_id)] = is_on
-                                # Cập nhật DB khi Timer chạy
-                                db_manager.update_device_state(did, {str(dp_id): is_on}) 
-                        else:
-                            if is_on: dev_obj.turn_on()
-                            else: dev_obj.turn_off()
-                            with data_lock:
-                                if '1' in info['dps']: info['dps']['1'] = is_on
-                                if '20' in info['dps']: info['dps']['20'] = is_on
-                                # Cập nhật DB
-                                db_manager.update_device_state(did, info['dps'])
-                    
-                    del active_timers[key]
-                except Exception as e:
-                    print(f"Lỗi Timer: {e}")
-        
-        # 2. QUÉT TRẠNG THÁI THIẾT BỊ
-        device_ids = list(tuya_cache.keys())
-        
-        for dev_id in device_ids:
+        # QUÉT CÁC THIẾT BỊ ĐẾN HẠN (song song theo từng IP)
+        # (Hẹn giờ chạy ở luồng riêng của timer_scheduler)
+        due = poll_scheduler.pop_due()
+        targets = []
+        for dev_id in due:
             info = tuya_cache.get(dev_id)
             if not info or info.get('missing_ip') or not info.get('obj'):
                 continue
-            
-            try:
-                dev = info['obj']
-                data = dev.status()
-                
-                if data and 'dps' in data:
-                    is_changed = False
-                    with data_lock:
-                        # Kiểm tra xem có gì mới không
-                        old_dps = info.get('dps', {})
-                        new_dps = data['dps']
-                        
-                        # Chỉ update DB nếu có thay đổi giá trị hoặc thiết bị vừa online lại
-                        if info.get('online') == False: 
-                            is_changed = True
-                        else:
-                            # So sánh đơn giản
-                            for k, v in new_dps.items():
-                                if str(k) not in old_dps or old_dps[str(k)] != v:
-                                    is_changed = True
-                                    break
-                        
-                        info['dps'].update(new_dps)
-                        info['online'] = True
-                        info['last_update'] = time.time()
-                    
-                    if is_changed:
-                        # Ghi trạng thái mới xuống DB
-                        # Chạy trong background thread nên không lo block UI chính
-                        db_manager.update_device_state(dev_id, new_dps, is_online=True)
-                        
-                elif 'Error' in str(data):
-                    if info.get('online'):
-                        info['online'] = False
-                        db_manager.update_device_state(dev_id, {}, is_online=False)
-            except:
-                info['online'] = False
-                
-            time.sleep(0.1)
+            targets.append((dev_id, info.get('ip')))
+        
+        if targets and async_client:
+            # Toàn bộ thiết bị chạy chung 1 event loop, không cần pool luồng
+            results = async_client.status_many([dev_id for dev_id, _ in targets])
+            for dev_id, data in results.items():
+                apply_status(dev_id, data)
+        elif targets:
+            poll_engine.run_cycle(targets)
+
+        # Thiết bị đến hạn nhưng bị bỏ qua vẫn phải có lịch lần sau
+        for dev_id in due:
+            poll_scheduler.ensure_scheduled(dev_id)
         
-        time.sleep(5)
+        next_due = poll_scheduler.next_due()
+        wait = POLL_TICK if next_due is None else next_due - time.time()
+        time.sleep(min(max(wait, 0.05), POLL_TICK))
 
-# Bắt đầu luồng chạy ngầm ngay khi import (hoặc khi chạy main)
-# Lưu ý: Flask khi chạy debug mode có thể load file 2 lần -> tạo 2 thread. 
-# Cần kiểm tra biến môi trường hoặc dùng lock file nếu cần thiết. 
-# Ở đây đơn giản hóa.
-if not os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-    poll_thread = threading.Thread(target=background_polling, daemon=True)
-    poll_thread.start()
+@app.teardown_request
+def release_db_conn(exc):
+    # Werkzeug chạy mỗi request trong 1 luồng mới: trả connection đọc về pool để request sau dùng lại
+    db_manager.release_thread_conn()
 
 @app.route('/')
 def index():
     return send_from_directory('.', 'index.html')
 
+def timers_by_device():
+    """
+    Chữ hiển thị hẹn giờ còn hạn, tính 1 lần cho mỗi request: dev_id -> {dp_id|'main': "BẬT sau Xp"}.
+    Dùng index theo thiết bị của timer_scheduler nên khớp đúng dev_id (không dùng startswith)
+    và chi phí O(số timer), không phụ thuộc số thiết bị.
+    """
+    now = time.time()
+    result = {}
+    for dev_id, dev_timers in timer_scheduler.list_by_device().items():
+        for dp_id, val in dev_timers.items():
+            total_seconds = int(val['end_time'] - now)
+            if total_seconds > 0:
+                mins = total_seconds // 60
+                ac = "BẬT" if val['action'] == 'on' else "TẮT"
+                result.setdefault(dev_id, {})[dp_id or 'main'] = f"{ac} sau {mins}p"
+    return result
+
+def device_to_json(dev_id, info, timers_info):
+    return {
+        "id": dev_id,
+        "name": info.get('name', f'Device {dev_id}'),
+        "type": info.get('type', 'unknown'),
+        "category": info.get('category', ''),
+        "ip": info.get('ip'),
+        "real_ip": info.get('real_ip', ''),
+        "version": info.get('version', 0.0),
+        "online": info.get('online', False), 
+        "missing_ip": info.get('missing_ip', True),
+        "via": info.get('via'),
+        "mapping": info.get('mapping', {}), 
+        "dps": info.get('dps', {}) ,
+        "timers": timers_info 
+    }
+
+def rebuild_snapshot():
+    """
+    Dựng snapshot mới: chỉ serialize lại thiết bị đã đổi (dirty_devices) hoặc có chữ hẹn giờ đổi,
+    các thiết bị còn lại dùng lại bytes cũ. data_lock chỉ giữ trong lúc serialize phần thay đổi.
+    """
+    global snapshot
+    old = snapshot
+    timers = timers_by_device()
+
+    # Lấy version và danh sách thay đổi cùng lúc: mọi thiết bị có rev <= version đều nằm trong dirty
+    with version_lock:
+        version = state_version
+        dirty = set(dirty_devices)
+        dirty_devices.clear()
+    for dev_id in old.timer_devices | set(timers):
+        frag = old.fragments.get(dev_id)
+        if frag is None or frag.timers != timers.get(dev_id, {}):
+            dirty.add(dev_id)
+    if not dirty and version == old.version:
+        return old
+
+    fragments = dict(old.fragments)
+    with data_lock:
+        for dev_id in dirty:
+            info = tuya_cache.get(dev_id)
+            if info is None:
+                fragments.pop(dev_id, None)
+                continue
+            dev_timers = timers.get(dev_id, {})
+            body = json.dumps(device_to_json(dev_id, info, dev_timers)).encode()
+            fragments[dev_id] = Fragment(info.get('rev', 0), dev_timers, body)
+
+    # Chữ "sau Xp" của hẹn giờ đổi theo thời gian dù Cache không đổi -> đưa vào ETag
+    timer_sig = zlib.crc32(json.dumps(timers, sort_keys=True).encode())
+    snapshot = Snapshot(version, f'"{version}-{timer_sig:x}"', fragments, frozenset(timers))
+    return snapshot
+
+def snapshot_delta(snap, since):
+    """
+    JSON (bytes) list thiết bị đổi sau version `since` (None = toàn bộ) từ 1 snapshot.
+    Returns: (full, body)
+    """
+    # since không thuộc phiên chạy này (server vừa restart) -> gửi lại toàn bộ
+    full = since is None or since < BOOT_VERSION or since > snap.version
+    # Thiết bị đang hẹn giờ luôn được gửi lại để cập nhật số phút còn lại
+    bodies = [f.body for f in snap.fragments.values() if full or f.rev > since or f.timers]
+    return full, b'[' + b','.join(bodies) + b']'
+
+def delta_json(snap, since):
+    full, devices = snapshot_delta(snap, since)
+    head = f'{{"version": {snap.version}, "full": {"true" if full else "false"}, "devices": '.encode()
+    return head + devices + b'}'
+
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
-    response_list = []
-    with data_lock:
-        for dev_id, info in tuya_cache.items():
-            
-            mapping = info.get('mapping', {})
-            timers_info = {}
-            
-            for key, val in active_timers.items():
-                if key.startswith(dev_id):
-                    parts = key.rsplit('_', 1)
-                    t_dp = parts[1] if len(parts) > 1 else 'main'
-                    remaining = val['end_time'] - datetime.now()
-                    total_seconds = int(remaining.total_seconds())
-                    if total_seconds > 0:
-                        mins = total_seconds // 60
-                        ac = "BẬT" if val['action'] == 'on' else "TẮT"
-                        timers_info[t_dp] = f"{ac} sau {mins}p"
-                        
-            response_list.append({
-                "id": dev_id,
-                "name": info.get('name', f'Device {dev_id}'),
-                "type": info.get('type', 'unknown'),
-                "category": info.get('category', ''),
-                "ip": info.get('ip'),
-                "real_ip": info.get('real_ip', ''),
-                "version": info.get('version', 0.0),
-                "online": info.get('online', False), 
-                "missing_ip": info.get('missing_ip', True),
-                "via": info.get('via'),
-                "mapping": mapping, 
-                "dps": info.get('dps', {}) ,
-                "timers": timers_info 
-            })
-    return jsonify(response_list)
+    """
+    GET /api/devices            -> list toàn bộ thiết bị (như cũ).
+    GET /api/devices?since=<v>  -> {"version", "full", "devices"}: chỉ thiết bị đổi sau version v.
+    Cả 2 đều có ETag; If-None-Match khớp -> 304 (không có gì mới).
+    Đọc từ snapshot dựng sẵn, không chờ data_lock của luồng poll.
+    """
+    since = request.args.get('since', type=int)
+    snap = snapshot
+    if request.if_none_match.contains(snap.etag.strip('"')):
+        return '', 304, {'ETag': snap.etag}
+
+    if since is None:
+        body = snapshot_delta(snap, None)[1]
+    else:
+        body = delta_json(snap, since)
+    return Response(body, mimetype='application/json', headers={'ETag': snap.etag})
+
+def sse_message(snap, since):
+    return f"id: {snap.version}\nevent: devices\ndata: ".encode() + delta_json(snap, since) + b"\n\n"
+
+def snapshot_builder():
+    """
+    Chờ mark_changed() báo có thay đổi (hoặc tới hạn cập nhật số phút hẹn giờ), dựng lại
+    snapshot rồi phát phần thay đổi chung cho mọi client đang mở /api/stream.
+    """
+    while True:
+        if state_changed.wait(TIMER_REFRESH):
+            time.sleep(STREAM_DEBOUNCE)
+        state_changed.clear()
+        try:
+            old = snapshot
+            snap = rebuild_snapshot()
+            if snap.etag != old.etag and event_hub.has_subscribers():
+                event_hub.publish(sse_message(snap, old.version))
+        except Exception as e:
+            print(f"Lỗi dựng snapshot: {e}")
+
+@app.route('/api/stream')
+def stream_devices():
+    """
+    Server-Sent Events: lần đầu gửi delta từ ?since= (hoặc Last-Event-ID khi trình duyệt
+    tự kết nối lại), sau đó đẩy thay đổi ngay khi có.
+    """
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', type=int)
+    # Đăng ký trước khi lấy snapshot: thay đổi sau đó chắc chắn nằm trong bản tin phát tiếp theo
+    sub = event_hub.subscribe()
+    snap = snapshot
+
+    def generate():
+        try:
+            yield sse_message(snap, since)
+            while not sub.evicted:
+                msg = sub.get(STREAM_KEEPALIVE)
+                yield msg if msg else b": ping\n\n"
+        finally:
+            event_hub.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """
+    GET /api/history?id=<dev_id>&dp=<dp_id>&start=<epoch>&end=<epoch>&points=<max>
+    Mặc định 24h gần nhất, tối đa 500 điểm. Độ phân giải (raw/phút/giờ/ngày) tự chọn theo khoảng thời gian.
+    """
+    dev_id = request.args.get('id')
+    dp_id = request.args.get('dp')
+    if not dev_id or not dp_id:
+        return jsonify({"success": False, "message": "Thiếu id hoặc dp"}), 400
+
+    end = request.args.get('end', type=float) or time.time()
+    start = request.args.get('start', type=float) or end - 86400
+    points = request.args.get('points', 500, type=int)
+    try:
+        result = db_manager.get_history(dev_id, dp_id, start, end, max_points=max(1, points))
+        return jsonify({"success": True, **result})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
 
 @app.route('/api/set_timer', methods=['POST'])
 def set_timer():
@@ -290,38 +815,12 @@ def set_timer():
     dev_id = data.get('id')
     dp_id = str(data.get('dp_id', '')) 
     minutes = int(data.get('minutes', 0))
-    timer_key = f"{dev_id}_{dp_id}"
 
-    if minutes <= 0:
-        if timer_key in active_timers:
-            del active_timers[timer_key]
-        return jsonify({"success": True, "message": "Đã hủy hẹn giờ."})
+    if minutes > 0 and dev_id not in tuya_cache:
+        return jsonify({"success": False}), 404
 
-    info = tuya_cache.get(dev_id)
-    if not info: return jsonify({"success": False}), 404
-    
-    dps = info.get('dps', {})
-    is_currently_on = False
-    
-    if dp_id and dp_id in dps:
-        is_currently_on = dps[dp_id]
-    else:
-        is_currently_on = dps.get('1') or dps.get('20') or False
-    
-    action = 'off' if is_currently_on else 'on'
-    end_time = datetime.now() + timedelta(minutes=minutes)
-    
-    active_timers[timer_key] = {
-        'end_time': end_time,
-        'action': action
-    }
-    
-    action_vn = "TẮT" if action == 'off' else "BẬT"
-    target_name = info['name']
-    if dp_id and 'mapping' in info and dp_id in info['mapping']:
-        target_name += " (" + info['mapping'][dp_id].get('name', dp_id) + ")"
-
-    return jsonify({"success": True, "message": f"Sẽ {action_vn} {target_name} sau {minutes} phút."})
+    result = set_device_timer(dev_id, dp_id, minutes)
+    return jsonify({"success": result['success'], "message": result['message']})
 
 @app.route('/api/update_config', methods=['POST'])
 def update_config():
@@ -355,7 +854,8 @@ def update_config():
         with data_lock:
             info = tuya_cache.get(dev_id)
             if info:
-                current_mapping = info.get('mapping', {})
+                # Sửa trên bản sao: init_device so mapping mới với Cache để biết có cần mark_changed
+                current_mapping = copy.deepcopy(info.get('mapping', {}))
                 str_dp = str(dp_id)
                 if str_dp not in current_mapping:
                     current_mapping[str_dp] = {"code": f"DP {str_dp}", "type": "String"}
@@ -368,8 +868,8 @@ def update_config():
         # Ghi vào DB
         db_manager.upsert_device(update_data)
         
-        # Load lại để cập nhật Cache
-        load_system()
+        # Chỉ nạp lại thiết bị vừa sửa (và thiết bị con nếu là Gateway)
+        reload_device(dev_id)
         return jsonify({"success": True, "message": "Đã lưu vào DB."})
     
     return jsonify({"success": False, "message": "Không có gì thay đổi."})
@@ -380,33 +880,40 @@ def control_device():
     dev_id = data.get('id')
     action = data.get('action') 
     dps_id = data.get('dps_id') 
+    dps = data.get('dps')   # Tùy chọn: {"1": true, "2": true, "3": false} -> gửi 1 frame
     
     info = tuya_cache.get(dev_id)
     if not info or not info.get('obj'):
         return jsonify({"success": False, "message": "Chưa có kết nối"}), 400
+    if dps is not None and not isinstance(dps, dict):
+        return jsonify({"success": False, "message": "dps phải là object {dp: value}"}), 400
 
     try:
-        dev_obj = info['obj']
-        if action in ['on', 'off']:
-            is_on = (action == 'on')
-            if dps_id:
-                dev_obj.set_value(str(dps_id), is_on)
-                with data_lock: info['dps'][str(dps_id)] = is_on 
-                # Cập nhật DB ngay sau khi điều khiển thành công
-                db_manager.update_device_state(dev_id, {str(dps_id): is_on})
-            else:
-                if is_on: dev_obj.turn_on()
-                else: dev_obj.turn_off()
-                with data_lock:
-                    if '1' in info['dps']: info['dps']['1'] = is_on
-                    if '20' in info['dps']: info['dps']['20'] = is_on
-                    # Cập nhật DB
-                    db_manager.update_device_state(dev_id, info['dps'])
+        if dps:
+            poll_scheduler.mark_active(dev_id)
+            set_device_dps(dev_id, info, dps)
+            mark_changed(dev_id)
+        elif action in ['on', 'off']:
+            poll_scheduler.mark_active(dev_id)
+            # switch_device chờ worker poll nhả socket của IP này trước khi gửi lệnh
+            switch_device(dev_id, info, dps_id, action == 'on')
+            mark_changed(dev_id)
 
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+@app.route('/api/control/batch', methods=['POST'])
+def control_batch_api():
+    targets = (request.json or {}).get('targets')
+    if not isinstance(targets, list) or not targets:
+        return jsonify({"success": False, "message": "Cần danh sách 'targets'"}), 400
+    try:
+        results = control_batch(targets)
+        return jsonify({"success": all(r['success'] for r in results), "results": results})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
 @app.route('/settings')
 def settings_page():
     return send_from_directory('.', 'settings.html')
@@ -423,12 +930,24 @@ def get_settings():
 def save_settings():
     try:
         data = request.json
-        for k, v in data.items():
-            db_manager.set_setting(k, v)
+        db_manager.set_settings(data)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+# Bắt đầu luồng chạy ngầm ngay khi import (hoặc khi chạy main)
+# Đặt cuối module: các luồng dùng hàm định nghĩa ở trên (snapshot_builder...)
+# Lưu ý: Flask khi chạy debug mode có thể load file 2 lần -> tạo 2 thread. 
+# Cần kiểm tra biến môi trường hoặc dùng lock file nếu cần thiết. 
+# Ở đây đơn giản hóa.
+if not os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    db_manager.init_db()
+
+    poll_thread = threading.Thread(target=background_polling, daemon=True)
+    poll_thread.start()
+    threading.Thread(target=snapshot_builder, daemon=True, name='snapshot-builder').start()
+    threading.Thread(target=history_jobs, daemon=True, name='history-jobs').start()
+
 if __name__ == '__main__':
     print("--> Server running: http://localhost:5000")
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -1,16 +1,19 @@
 # FILE: master_mcp.py
 from mcp.server.fastmcp import FastMCP
+import asyncio
+import functools
 import logging
 import sys
 import threading
-from datetime import datetime, timedelta
-import io
+from concurrent.futures import ThreadPoolExecutor
 
 # FORCE UTF-8 ENCODING FOR WINDOWS
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+# reconfigure thay vì bọc TextIOWrapper mới: master_mcp import main, wrapper cũ bị thu hồi sẽ đóng luôn stdout
+sys.stdout.reconfigure(encoding='utf-8')
+sys.stderr.reconfigure(encoding='utf-8')
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+logger = logging.getLogger('master_mcp')
 
 # 1. IMPORT CÁC MODULE CON
 import tuya_mcp
@@ -21,6 +24,8 @@ import email_mcp
 # 2. IMPORT WEB SERVER
 try:
     import main as web_server
+    # Tool thiết bị đọc/ghi qua poller của Web (chung socket, Cache), không mở kết nối thứ 2
+    tuya_mcp.set_web_backend(web_server)
 except ImportError as e:
     sys.stderr.write(f"Loi import main.py: {e}\n")
 
@@ -29,6 +34,28 @@ mcp = FastMCP("XiaoZhi_Smart_Home")
 # GLOBAL SERVICES
 email_service = email_mcp.EmailMCP()
 
+# --- CHẠY TOOL KHÔNG CHẶN SERVER ---
+# Tool là hàm đồng bộ (socket tinytuya, SQLite, HTTP). Chạy thẳng trong event loop thì 1 thiết bị
+# chậm/Offline làm treo cả server stdio; chạy trong pool này thì các lệnh độc lập chạy song song.
+TOOL_WORKERS = 8
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix='mcp-tool')
+
+def async_tool(func, timeout):
+    """
+    Bọc tool đồng bộ thành async: chạy trong tool_executor, quá timeout giây thì trả lời ngay.
+    Client hủy lệnh (hoặc hết giờ) khi lệnh còn chờ trong hàng đợi -> lệnh không chạy nữa;
+    lệnh đang chạy thì chạy nốt (tự dừng theo timeout socket), kết quả bỏ đi.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        future = asyncio.get_running_loop().run_in_executor(tool_executor, functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool {func.__name__} timed out after {timeout}s")
+            return f"Quá thời gian chờ ({timeout} giây), thiết bị hoặc dịch vụ không phản hồi. Vui lòng thử lại sau."
+    return wrapper
+
 # --- HÀM KHỞI CHẠY WEB SERVER ---
 def start_flask():
     sys.stderr.write("--> Starting Flask Web Server on port 5000...\n")
@@ -42,76 +69,38 @@ def set_timer_tool(device_name: str, minutes: int) -> str:
         device_name: Tên thiết bị (VD: 'Quạt', 'Đèn trần', 'Công tắc 1').
         minutes: Số phút đếm ngược (VD: 30). Nhập 0 để hủy hẹn giờ.
     """
-    # 1. Cập nhật danh sách thiết bị mới nhất để tìm kiếm
-    tuya_mcp.load_devices() 
-    
-    # 2. Tìm kiếm thiết bị theo tên
-    target_name = device_name.lower().strip()
-    target_info = None
-
-    if target_name in tuya_mcp.device_lookup:
-        target_info = tuya_mcp.device_lookup[target_name]
-    else:
-        # Tìm gần đúng
-        for key, info in tuya_mcp.device_lookup.items():
-            if target_name in key:
-                target_info = info
-                break
-    
+    # 1. Tìm thiết bị theo tên (chỉ mục chỉ dựng lại khi danh sách thiết bị đổi)
+    target_info, candidates = tuya_mcp.find_device(device_name)
     if not target_info:
-        return f"Không tìm thấy thiết bị tên là '{device_name}'."
+        return tuya_mcp.ambiguous_message(device_name, candidates) or f"Không tìm thấy thiết bị tên là '{device_name}'."
 
-    # 3. Lấy thông tin định danh
+    # 2. Lấy thông tin định danh
     dev_id = target_info['id']
     dp_id = target_info.get('dp') # Lấy ID nút con (nếu là switch nhiều nút)
     
-    # Chuẩn hóa dp_id để khớp với key trong main.py (nếu None thì là chuỗi rỗng)
-    safe_dp_id = str(dp_id) if dp_id else ""
-    timer_key = f"{dev_id}_{safe_dp_id}"
+    # 3. Đặt/Hủy qua bộ hẹn giờ chung của Web Server (lưu DB, chạy đúng giờ)
+    result = web_server.set_device_timer(dev_id, dp_id, minutes)
 
-    # 4. Xử lý Hủy Timer
     if minutes <= 0:
-        if timer_key in web_server.active_timers:
-            del web_server.active_timers[timer_key]
+        if result['cancelled']:
             return f"Đã hủy hẹn giờ cho {target_info['name']}."
         return f"Thiết bị {target_info['name']} hiện không có hẹn giờ nào."
 
-    # 5. Xác định hành động (Bật hay Tắt?) dựa trên trạng thái hiện tại
-    info = web_server.tuya_cache.get(dev_id)
-    if not info: return "Không lấy được thông tin thiết bị."
-    
-    dps = info.get('dps', {})
-    is_currently_on = False
-
-    if dp_id and str(dp_id) in dps:
-        # Nếu là nút con, lấy trạng thái nút con
-        is_currently_on = dps[str(dp_id)]
-    else:
-        # Nếu là thiết bị đơn, lấy trạng thái chung (thường là 1 hoặc 20)
-        is_currently_on = dps.get('1') or dps.get('20') or False
-
-    # Logic đảo ngược: Đang Bật -> Hẹn Tắt, Đang Tắt -> Hẹn Bật
-    action = 'off' if is_currently_on else 'on'
-    end_time = datetime.now() + timedelta(minutes=minutes)
-
-    # 6. Ghi vào bộ nhớ của Web Server
-    web_server.active_timers[timer_key] = {
-        'end_time': end_time,
-        'action': action
-    }
-
-    action_vn = "TẮT" if action == 'off' else "BẬT"
+    if not result['success']: return "Không lấy được thông tin thiết bị."
+
+    action_vn = "TẮT" if result['action'] == 'off' else "BẬT"
     return f"Đã đặt lịch: {target_info['name']} sẽ {action_vn} sau {minutes} phút nữa."
 
 # --- TOOL TRA CỨU THÔNG BÁO ---
 def check_notifications(query: str) -> str:
     """Tra cứu các thông báo từ Ban Quản Lý hoặc Hóa đơn."""
+    # Kết quả đã xếp theo mức độ liên quan (FTS5 bm25), không phân biệt dấu
     results = db_manager.search_emails(query)
     if not results: return "Không tìm thấy thông báo nào liên quan."
     
-    msg = f"Tìm thấy {len(results)} thông báo:\n"
-    for r in results:
-        msg += f"- [{r['received_at']}] {r['subject']}\n"
+    msg = f"Tìm thấy {len(results)} thông báo (liên quan nhất trước):\n"
+    for i, r in enumerate(results, 1):
+        msg += f"{i}. [{r['received_at']}] {r['subject']}\n"
         if r['summary']: msg += f"  Nội dung: {r['summary'][:100]}...\n"
     return msg
 
@@ -127,15 +116,16 @@ def get_latest_bill() -> str:
     
     return f"Hóa đơn mới nhất ({b['received_at']}):\nTiêu đề: {b['subject']}\nTháng: {month}\nSố tiền: {amount}"
 
-# 3. ĐĂNG KÝ CÁC TOOLS
-mcp.add_tool(tuya_mcp.list_devices, name="Danh_sach_thiet_bi", description="Liệt kê tên các thiết bị.")
-mcp.add_tool(tuya_mcp.control_device, name="Dieu_khien_thiet_bi", description="Bật hoặc tắt ngay lập tức.")
-mcp.add_tool(tuya_mcp.check_status, name="Kiem_tra_trang_thai", description="Kiểm tra xem thiết bị đang Bật hay Tắt.")
-mcp.add_tool(set_timer_tool, name="Hen_gio_thiet_bi", description="Hẹn giờ bật hoặc tắt thiết bị sau một khoảng thời gian (phút).")
+# 3. ĐĂNG KÝ CÁC TOOLS (timeout: giây, tính cả thời gian chờ trong hàng đợi)
+mcp.add_tool(async_tool(tuya_mcp.list_devices, 10), name="Danh_sach_thiet_bi", description="Liệt kê tên các thiết bị.")
+mcp.add_tool(async_tool(tuya_mcp.control_device, 15), name="Dieu_khien_thiet_bi", description="Bật hoặc tắt ngay lập tức.")
+mcp.add_tool(async_tool(tuya_mcp.control_devices, 30), name="Dieu_khien_nhieu_thiet_bi", description="Bật hoặc tắt nhiều thiết bị cùng lúc (danh sách tên).")
+mcp.add_tool(async_tool(tuya_mcp.check_status, 15), name="Kiem_tra_trang_thai", description="Kiểm tra xem thiết bị đang Bật hay Tắt.")
+mcp.add_tool(async_tool(set_timer_tool, 10), name="Hen_gio_thiet_bi", description="Hẹn giờ bật hoặc tắt thiết bị sau một khoảng thời gian (phút).")
 
 # Tools Email
-mcp.add_tool(check_notifications, name="Kiem_tra_thong_bao", description="Tra cứu thông báo từ BQL theo từ khóa.")
-mcp.add_tool(get_latest_bill, name="Kiem_tra_hoa_don", description="Xem thông tin hóa đơn điện nước mới nhất.")
+mcp.add_tool(async_tool(check_notifications, 10), name="Kiem_tra_thong_bao", description="Tra cứu thông báo từ BQL theo từ khóa.")
+mcp.add_tool(async_tool(get_latest_bill, 10), name="Kiem_tra_hoa_don", description="Xem thông tin hóa đơn điện nước mới nhất.")
 
 if __name__ == "__main__":
     flask_thread = threading.Thread(target=start_flask, daemon=True)
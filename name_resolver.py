@@ -0,0 +1,137 @@
+# FILE: name_resolver.py
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain
+
+# Mức khớp (cao hơn = tốt hơn)
+TIER_EXACT = 4      # Trùng cả tên (không phân biệt dấu/hoa thường)
+TIER_TOKENS = 3     # Mọi từ của câu hỏi đều là 1 từ trong tên
+TIER_PREFIX = 2     # Mọi từ của câu hỏi đều là đầu của 1 từ trong tên ("cong tac" -> "công tắc")
+TIER_FUZZY = 1      # Giống gần đúng theo trigram (sai chính tả, dính chữ)
+
+FUZZY_MIN = 0.45        # Độ giống trigram tối thiểu (Dice) để tính là khớp
+FUZZY_MARGIN = 0.1      # 2 kết quả fuzzy cách nhau ít hơn mức này -> mơ hồ
+
+def fold(text):
+    """'Đèn Trần' -> 'den tran': bỏ dấu tiếng Việt, chữ thường, gộp khoảng trắng."""
+    text = (text or '').lower().replace('đ', 'd')
+    text = ''.join(ch for ch in unicodedata.normalize('NFD', text) if not unicodedata.combining(ch))
+    return ' '.join(re.findall(r'\w+', text))
+
+def plain(text):
+    """'Đèn-Trần' -> 'đèn trần': chữ thường, gộp khoảng trắng/dấu câu, giữ dấu tiếng Việt."""
+    return ' '.join(re.findall(r'\w+', unicodedata.normalize('NFC', (text or '').lower())))
+
+def trigrams(folded):
+    padded = f" {folded} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class NameResolver:
+    """
+    Chỉ mục tên thiết bị/nút cho lệnh giọng nói.
+
+    - Dựng 1 lần mỗi khi danh sách thiết bị đổi (tuya_mcp.load_devices).
+    - Tra: tên trùng khớp -> postings theo từ (kể cả tiền tố, qua danh sách từ đã sắp xếp)
+      -> postings trigram (gần đúng). Chỉ chấm điểm các ứng viên lấy từ postings,
+      nên không phải quét toàn bộ danh sách.
+    - Kết quả xếp hạng tất định: (mức khớp, đúng dấu, độ giống) rồi tên ngắn hơn (phủ nhiều hơn), rồi theo tên.
+    - Nhiều ứng viên ngang hạng, hoặc chỉ khớp gần đúng -> trả về danh sách để hỏi lại thay vì chọn bừa.
+    """
+
+    def __init__(self, entries):
+        # entries: các dict có 'name' (VD: giá trị của device_lookup: {'id', 'dp', 'name'})
+        # Sắp theo (độ dài, tên): chỉ số i càng nhỏ = tên càng ngắn, nên i dùng luôn làm tiêu chí phụ
+        keyed = sorted(((len(fold(e['name'])), fold(e['name']), e['name'], str(e.get('id')), str(e.get('dp'))), e) for e in entries)
+        self.entries = [e for _, e in keyed]
+        self.folded = [k[1] for k, _ in keyed]
+        self.raw = [' '.join((e['name'] or '').lower().split()) for e in self.entries]
+        self.plain = [plain(e['name']) for e in self.entries]
+        self.tokens = [f.split() for f in self.folded]
+        self.gram_counts = []
+        self.exact = {}
+        self.token_postings = {}
+        self.trigram_postings = {}
+        for i, f in enumerate(self.folded):
+            self.exact.setdefault(f, []).append(i)
+            for t in set(self.tokens[i]):
+                self.token_postings.setdefault(t, []).append(i)
+            grams = trigrams(f)
+            self.gram_counts.append(len(grams))
+            for g in grams:
+                self.trigram_postings.setdefault(g, []).append(i)
+        self.token_postings = {t: frozenset(ids) for t, ids in self.token_postings.items()}
+        self.vocab = sorted(self.token_postings)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _prefix_postings(self, token):
+        """Ứng viên có 1 từ bắt đầu bằng token."""
+        result = set()
+        i = bisect_left(self.vocab, token)
+        while i < len(self.vocab) and self.vocab[i].startswith(token):
+            result.update(self.token_postings[self.vocab[i]])
+            i += 1
+        return result
+
+    def _rank_keys(self, ids, tier, raw_query):
+        # Gõ đúng dấu được ưu tiên: 'đèn' xếp 'Đèn bàn' trên 'Đen' (cùng là 'den' khi bỏ dấu)
+        raw = self.raw
+        return [(-tier, -1 if raw_query in raw[i] else 0, 0.0, i) for i in ids]
+
+    def _search(self, query, limit):
+        """[(tier, accent, quality, entry)], tốt nhất trước."""
+        q = fold(query)
+        if not q: return []
+        raw_query = ' '.join((query or '').lower().split())
+        q_tokens = q.split()
+        scored = []
+
+        # Trùng cả tên chỉ chốt ngay khi dấu cũng khớp (hoặc câu hỏi không dấu): 'đèn' trùng 'Đen'
+        # khi bỏ dấu nhưng sai dấu -> xếp chung với khớp theo từ, 'Đèn bàn'/'Đèn trần' đứng trên
+        q_plain = plain(query)
+        exact_ids = [i for i in self.exact.get(q, ()) if q_plain in (q, self.plain[i])]
+        if exact_ids:
+            scored = self._rank_keys(exact_ids, TIER_EXACT, raw_query)
+
+        if not scored:
+            # Từ khớp trọn vẹn / tiền tố: giao postings của từng từ (tên ngắn hơn = phủ nhiều hơn = i nhỏ hơn)
+            empty = frozenset()
+            token_ids = frozenset.intersection(*[self.token_postings.get(t, empty) for t in q_tokens])
+            prefix_ids = set.intersection(*[self._prefix_postings(t) for t in q_tokens]) - token_ids
+            scored = self._rank_keys(token_ids, TIER_TOKENS, raw_query) + self._rank_keys(prefix_ids, TIER_PREFIX, raw_query)
+
+        if not scored:
+            # Gần đúng: đếm trigram chung qua postings, Dice = 2*chung / (tổng)
+            q_grams = trigrams(q)
+            qg, counts, raw = len(q_grams), self.gram_counts, self.raw
+            shared = Counter(chain.from_iterable(self.trigram_postings.get(g, ()) for g in q_grams))
+            scored = [(-TIER_FUZZY, -1 if raw_query in raw[i] else 0, -2 * n / (qg + counts[i]), i)
+                      for i, n in shared.items() if 2 * n >= FUZZY_MIN * (qg + counts[i])]
+
+        return [(-k[0], -k[1], -k[2], self.entries[k[3]]) for k in heapq.nsmallest(limit, scored)]
+
+    def search(self, query, limit=5):
+        """Các entry khớp nhất, tốt nhất trước."""
+        return [r[3] for r in self._search(query, limit)]
+
+    def resolve(self, query, limit=5):
+        """
+        Trả về (entry, candidates):
+        - (entry, [])         : tìm thấy 1 kết quả rõ ràng
+        - (None, [e1, e2...]) : mơ hồ, nhiều kết quả ngang hạng (tốt nhất trước)
+        - (None, [e])         : chỉ giống gần đúng (fuzzy) -> hỏi lại, không tự chọn: 'quạt trần'
+                                khi chỉ có 'Quạt' có thể là thiết bị chưa có, bật nhầm thì tệ hơn hỏi
+        - (None, [])          : không tìm thấy
+        """
+        results = self._search(query, limit)
+        if not results: return None, []
+        best_tier, best_accent, best_quality, best = results[0]
+        ties = [e for tier, accent, quality, e in results if (tier, accent) == (best_tier, best_accent) and
+                (tier != TIER_FUZZY or best_quality - quality < FUZZY_MARGIN)]
+        if len(ties) > 1 or best_tier == TIER_FUZZY:
+            return None, ties
+        return best, []
@@ -0,0 +1,167 @@
+# FILE: poll_scheduler.py
+import heapq
+import math
+import threading
+import time
+import logging
+
+# Setup Logger riêng
+logger = logging.getLogger('poll_scheduler')
+
+# Chu kỳ poll theo loại thiết bị (kết quả của determine_device_type), đơn vị giây:
+# (fast: vừa thay đổi/vừa điều khiển, base: mặc định, max: ổn định lâu)
+TYPE_PROFILES = {
+    'switch':    (2, 5, 30),
+    'light':     (2, 5, 30),
+    'gateway':   (5, 15, 60),
+    'sensor':    (5, 30, 120),
+    'ir_remote': (30, 120, 600),
+    'unknown':   (5, 15, 60),
+}
+
+ACTIVE_WINDOW = 60          # Sau khi đổi trạng thái/điều khiển, giữ chu kỳ fast trong bấy nhiêu giây
+STABLE_GROWTH = 1.5         # Hệ số giãn chu kỳ khi thiết bị ổn định
+OFFLINE_BACKOFF_START = 10  # Lần thử lại đầu tiên khi offline
+OFFLINE_BACKOFF_MAX = 300   # Tối đa 1 lần thử / 5 phút cho thiết bị offline
+PUSH_REFRESH_INTERVAL = 300 # Thiết bị tự đẩy trạng thái chỉ cần poll đối chiếu thỉnh thoảng
+
+class PollScheduler:
+    """
+    Lịch poll theo từng thiết bị, dùng hàng đợi ưu tiên (heap) theo thời điểm đến hạn.
+
+    - Thiết bị vừa thay đổi hoặc vừa điều khiển: poll nhanh (fast) trong ACTIVE_WINDOW.
+    - Thiết bị ổn định: chu kỳ giãn dần từ base tới max.
+    - Thiết bị offline: lùi theo cấp số nhân, tối đa OFFLINE_BACKOFF_MAX.
+
+    Xoá/đổi lịch dùng "lazy deletion": mỗi lần đặt lịch có token mới, bản ghi cũ
+    trong heap bị bỏ qua khi lấy ra, nên thêm/đổi lịch đều O(log n).
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}   # dev_id -> trạng thái lịch
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def profile(self, dev_type):
+        return TYPE_PROFILES.get(dev_type, TYPE_PROFILES['unknown'])
+
+    def _push(self, entry, due):
+        # Làm tròn lên giây để các thiết bị con cùng Gateway dễ rơi vào cùng 1 lô
+        due = math.ceil(due)
+        self.counter += 1
+        entry['token'] = self.counter
+        entry['due'] = due
+        entry['scheduled'] = True
+        heapq.heappush(self.heap, (due, self.counter, entry['id']))
+
+    def add(self, dev_id, dev_type, due=None):
+        """Thêm thiết bị (hoặc cập nhật loại nếu đã có)."""
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if entry:
+                entry['type'] = dev_type
+                return
+            fast, base, _ = self.profile(dev_type)
+            entry = {"id": dev_id, "type": dev_type, "interval": base, "fails": 0, "last_change": 0.0, "push": False}
+            self.entries[dev_id] = entry
+            self._push(entry, time.time() if due is None else due)
+
+    def remove(self, dev_id):
+        with self.lock:
+            self.entries.pop(dev_id, None)
+
+    def pop_due(self, now=None):
+        """Lấy danh sách thiết bị đã đến hạn. Chúng nằm ngoài lịch cho tới khi record_result()."""
+        now = now or time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, token, dev_id = heapq.heappop(self.heap)
+                entry = self.entries.get(dev_id)
+                if not entry or entry['token'] != token:
+                    continue
+                entry['scheduled'] = False
+                due.append(dev_id)
+        return due
+
+    def next_due(self):
+        with self.lock:
+            while self.heap:
+                _, token, dev_id = self.heap[0]
+                entry = self.entries.get(dev_id)
+                if entry and entry['token'] == token:
+                    return self.heap[0][0]
+                heapq.heappop(self.heap)
+        return None
+
+    def record_result(self, dev_id, online, changed=False, now=None):
+        """Ghi nhận kết quả poll (hoặc bản tin tự đẩy) và đặt lịch lần tiếp theo."""
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if not entry: return
+            fast, base, max_interval = self.profile(entry['type'])
+
+            if not online:
+                entry['fails'] += 1
+                interval = min(OFFLINE_BACKOFF_MAX, OFFLINE_BACKOFF_START * (2 ** (entry['fails'] - 1)))
+            else:
+                entry['fails'] = 0
+                if changed:
+                    entry['last_change'] = now
+                if entry['push']:
+                    interval = PUSH_REFRESH_INTERVAL
+                elif now - entry['last_change'] < ACTIVE_WINDOW:
+                    interval = fast
+                else:
+                    interval = min(max_interval, max(base, entry['interval'] * STABLE_GROWTH))
+                entry['interval'] = interval
+
+            self._push(entry, now + interval)
+
+    def record_push(self, dev_id, changed=False, now=None):
+        """
+        Ghi nhận bản tin thiết bị tự đẩy: còn sống (+ có thay đổi) nhưng KHÔNG dời lịch poll,
+        để thiết bị đẩy dày vẫn có lần poll đầy đủ/đối chiếu đúng hạn.
+        """
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if not entry: return
+            entry['push'] = True
+            entry['fails'] = 0
+            if changed: entry['last_change'] = now
+
+    def poll_now(self, dev_id, now=None):
+        """Đưa thiết bị lên đầu hàng đợi (VD: vừa kết nối lại, cần đọc đủ trạng thái)."""
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if entry: self._push(entry, now)
+
+    def set_push(self, dev_id, enabled):
+        """Đánh dấu thiết bị đang tự đẩy trạng thái qua socket giữ kết nối (chế độ push)."""
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if entry: entry['push'] = enabled
+
+    def mark_active(self, dev_id, now=None):
+        """Thiết bị vừa được điều khiển: poll lại sớm để xác nhận trạng thái."""
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if not entry: return
+            fast, _, _ = self.profile(entry['type'])
+            entry['last_change'] = now
+            entry['interval'] = fast
+            entry['fails'] = 0
+            self._push(entry, now + fast)
+
+    def ensure_scheduled(self, dev_id, now=None):
+        """Đặt lại lịch mặc định cho thiết bị đã lấy ra nhưng không được poll."""
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.get(dev_id)
+            if entry and not entry['scheduled']:
+                self._push(entry, now + self.profile(entry['type'])[1])
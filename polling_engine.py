@@ -0,0 +1,84 @@
+# FILE: polling_engine.py
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Setup Logger riêng
+logger = logging.getLogger('polling_engine')
+
+class PollingEngine:
+    """
+    Poll nhiều thiết bị song song bằng một pool luồng có giới hạn.
+
+    Các thiết bị dùng chung một IP (Gateway Zigbee và các thiết bị con) được gom
+    vào cùng một "làn" và poll tuần tự trong làn đó, nên một socket không bao giờ
+    bị hai worker dùng cùng lúc. Các làn khác nhau chạy song song, vì vậy thời gian
+    một vòng quét xấp xỉ thời gian của làn chậm nhất thay vì tổng tất cả thiết bị.
+    """
+
+    def __init__(self, poll_func, max_workers=8, lane_func=None):
+        self.poll_func = poll_func          # poll_func(dev_id) -> kết quả bất kỳ
+        self.lane_func = lane_func          # lane_func(ip, dev_ids) -> dict, poll cả làn 1 lần (VD: Gateway)
+        self.max_workers = max(1, int(max_workers))
+        self.executor = None
+        self.ip_locks = {}
+        self.locks_guard = threading.Lock()
+        self.last_cycle_time = 0.0
+
+    def configure(self, max_workers):
+        """Đổi số worker. Chỉ có hiệu lực trước vòng quét đầu tiên."""
+        if self.executor is None:
+            self.max_workers = max(1, int(max_workers))
+
+    def ip_lock(self, ip):
+        """Lock theo IP. Dùng chung cho polling và các lệnh điều khiển tới cùng socket."""
+        with self.locks_guard:
+            lock = self.ip_locks.get(ip)
+            if lock is None:
+                lock = threading.Lock()
+                self.ip_locks[ip] = lock
+            return lock
+
+    def run_lane(self, ip, dev_ids):
+        results = {}
+        with self.ip_lock(ip):
+            if self.lane_func:
+                try: return self.lane_func(ip, dev_ids) or {}
+                except Exception as e:
+                    logger.error(f"Lane poll error {ip}: {e}")
+                    return {dev_id: None for dev_id in dev_ids}
+            for dev_id in dev_ids:
+                try:
+                    results[dev_id] = self.poll_func(dev_id)
+                except Exception as e:
+                    logger.error(f"Poll error {dev_id}: {e}")
+                    results[dev_id] = None
+        return results
+
+    def run_cycle(self, targets):
+        """
+        Chạy một vòng quét.
+        Args:
+            targets: list các tuple (dev_id, ip).
+        Returns:
+            dict dev_id -> kết quả của poll_func.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='tuya-poll')
+
+        lanes = {}
+        for dev_id, ip in targets:
+            lanes.setdefault(ip, []).append(dev_id)
+
+        start = time.time()
+        futures = [self.executor.submit(self.run_lane, ip, ids) for ip, ids in lanes.items()]
+        wait(futures)
+
+        results = {}
+        for f in futures:
+            try: results.update(f.result())
+            except Exception as e: logger.error(f"Lane error: {e}")
+
+        self.last_cycle_time = time.time() - start
+        return results
@@ -13,7 +13,7 @@ def speak(text, volume=None):
     try:
         if volume is None:
             # Lấy volume từ settings, mặc định 4
-            volume = int(db_manager.get_setting('speaker_volume', 4))
+            volume = db_manager.get_setting('speaker_volume', 4, int)
         
         logger.info(f"📢 [SPEAK] Vol={volume}: {text}")
         print(f"📢 [LOA] Đang đọc: {text}")
@@ -0,0 +1,129 @@
+# FILE: timer_scheduler.py
+import heapq
+import threading
+import time
+import logging
+from datetime import datetime
+import db_manager
+
+# Setup Logger riêng
+logger = logging.getLogger('timer_scheduler')
+
+class TimerScheduler:
+    """
+    Bộ hẹn giờ Bật/Tắt thiết bị.
+
+    - Min-heap theo thời điểm kích hoạt + luồng riêng ngủ đúng tới hạn kế tiếp,
+      nên timer chạy đúng giờ thay vì chờ hết 1 vòng poll.
+    - Lưu vào bảng `timers` trong SQLite, khởi động lại không mất hẹn giờ.
+    - Mỗi (dev_id, dp_id) chỉ có 1 timer. Thêm/hủy O(log n): bản ghi cũ trong
+      heap bị bỏ qua khi lấy ra (lazy deletion).
+    - Thread-safe: Flask và MCP tool gọi chung 1 object.
+    """
+
+    def __init__(self, fire_callback):
+        self.fire_callback = fire_callback   # fire_callback(dev_id, dp_id, action)
+        self.heap = []
+        self.timers = {}    # (dev_id, dp_id) -> {"dev_id", "dp_id", "action", "end_time", "token"}
+        self.by_device = {} # dev_id -> {dp_id: timer} (cùng object với self.timers)
+        self.cond = threading.Condition()
+        self.counter = 0
+        self.thread = None
+
+    @staticmethod
+    def normalize_dp(dp_id):
+        # dp_id rỗng = cả thiết bị (tương thích key cũ f"{dev_id}_{dp_id}" với dp_id '' hoặc 'None')
+        return "" if dp_id in (None, "", "None") else str(dp_id)
+
+    def start(self):
+        with self.cond:
+            if self.thread: return
+            for row in db_manager.get_all_timers():
+                self._push(row['dev_id'], row['dp_id'], row['action'], row['end_time'])
+            self.thread = threading.Thread(target=self.run, daemon=True, name='timer-scheduler')
+            self.thread.start()
+        logger.info(f"Timer scheduler started with {len(self.timers)} persisted timers")
+
+    def _push(self, dev_id, dp_id, action, end_ts):
+        self.counter += 1
+        timer = {
+            "dev_id": dev_id, "dp_id": dp_id, "action": action,
+            "end_time": end_ts, "token": self.counter
+        }
+        self.timers[(dev_id, dp_id)] = timer
+        self.by_device.setdefault(dev_id, {})[dp_id] = timer
+        heapq.heappush(self.heap, (end_ts, self.counter, dev_id, dp_id))
+
+    def add(self, dev_id, dp_id, action, end_time):
+        """Thêm (hoặc thay) timer. end_time: datetime hoặc epoch giây."""
+        dp_id = self.normalize_dp(dp_id)
+        end_ts = end_time.timestamp() if isinstance(end_time, datetime) else float(end_time)
+        db_manager.save_timer(dev_id, dp_id, action, end_ts)
+        with self.cond:
+            self._push(dev_id, dp_id, action, end_ts)
+            self.cond.notify()
+
+    def _pop(self, dev_id, dp_id):
+        timer = self.timers.pop((dev_id, dp_id), None)
+        if timer:
+            dev_timers = self.by_device[dev_id]
+            del dev_timers[dp_id]
+            if not dev_timers: del self.by_device[dev_id]
+        return timer
+
+    def cancel(self, dev_id, dp_id):
+        """Hủy timer. Trả về True nếu có timer bị hủy."""
+        dp_id = self.normalize_dp(dp_id)
+        with self.cond:
+            timer = self._pop(dev_id, dp_id)
+        if timer:
+            db_manager.delete_timer(dev_id, dp_id, timer['end_time'])
+        return timer is not None
+
+    def get(self, dev_id, dp_id):
+        with self.cond:
+            t = self.timers.get((dev_id, self.normalize_dp(dp_id)))
+            return dict(t) if t else None
+
+    def list_timers(self):
+        with self.cond:
+            return [dict(t) for t in self.timers.values()]
+
+    def timers_for(self, dev_id):
+        """Các timer của 1 thiết bị: {dp_id: timer}. O(số timer của thiết bị đó)."""
+        with self.cond:
+            return {dp: dict(t) for dp, t in self.by_device.get(dev_id, {}).items()}
+
+    def list_by_device(self):
+        """Toàn bộ timer gom theo thiết bị: dev_id -> {dp_id: timer}."""
+        with self.cond:
+            return {dev_id: {dp: dict(t) for dp, t in dev_timers.items()}
+                    for dev_id, dev_timers in self.by_device.items()}
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    # Bỏ các bản ghi đã bị hủy/thay thế
+                    while self.heap:
+                        end_ts, token, dev_id, dp_id = self.heap[0]
+                        t = self.timers.get((dev_id, dp_id))
+                        if t and t['token'] == token: break
+                        heapq.heappop(self.heap)
+
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    wait = self.heap[0][0] - time.time()
+                    if wait <= 0: break
+                    self.cond.wait(wait)
+
+                end_ts, token, dev_id, dp_id = heapq.heappop(self.heap)
+                timer = self._pop(dev_id, dp_id)
+
+            # Chỉ xoá đúng bản ghi vừa chạy (có thể đã có timer mới cùng key được lưu)
+            db_manager.delete_timer(dev_id, dp_id, end_ts)
+            try:
+                self.fire_callback(dev_id, dp_id, timer['action'])
+            except Exception as e:
+                logger.error(f"Timer error {dev_id} (DP {dp_id}): {e}")
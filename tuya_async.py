@@ -0,0 +1,387 @@
+# FILE: tuya_async.py
+import asyncio
+import threading
+import struct
+import time
+import logging
+from collections import namedtuple
+import tinytuya
+
+# Setup Logger riêng
+logger = logging.getLogger('tuya_async')
+
+HEADER_LEN_55AA = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_55AA)
+HEADER_LEN_6699 = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_6699)
+
+RECONNECT_BACKOFF_START = 5   # Giây chờ trước lần kết nối lại đầu tiên (chế độ push)
+RECONNECT_BACKOFF_MAX = 300
+
+# Bản tin chờ phản hồi: tập cmd chấp nhận, có cần payload không, cid mong đợi, future trả kết quả
+Waiter = namedtuple('Waiter', 'cmds need_payload cid future')
+
+class AsyncTuyaConnection:
+    """
+    Một socket TCP tới 1 IP (thiết bị WiFi hoặc Gateway Zigbee).
+
+    Phần mã hoá/giải mã, đóng gói bản tin và bắt tay session key (3.4/3.5) dùng lại
+    codec của tinytuya, chỉ phần vận chuyển là asyncio. Một task đọc liên tục nhận
+    mọi bản tin: bản tin khớp với lệnh đang chờ thì trả về cho lệnh đó, còn lại là
+    bản tin thiết bị tự đẩy lên và được chuyển cho callback on_push.
+    """
+
+    def __init__(self, dev_id, ip, key, version=3.3, port=tinytuya.TCPPORT, timeout=2.0, on_push=None):
+        self.codec = tinytuya.Device(dev_id, ip, key, version=version, port=port)
+        self.ip = ip
+        self.port = port
+        self.key = key
+        self.timeout = timeout
+        self.on_push = on_push   # on_push(dev_id, data)
+        self.children = {}       # dev_id -> codec con (Zigbee, dùng chung socket)
+        self.cid_map = {}        # cid -> dev_id
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.lock = None
+        self.waiter = None
+        self.last_rx = 0.0
+        self.last_tx = 0.0
+        self.link_up = None      # Trạng thái link lần báo gần nhất (chế độ push)
+        self.retry_at = 0.0
+        self.backoff = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    def codec_for(self, dev_id, cid=None):
+        if not cid or dev_id == self.codec.id:
+            return self.codec
+        child = self.children.get(dev_id)
+        if child is None:
+            child = tinytuya.Device(dev_id, cid=cid, parent=self.codec)
+            self.children[dev_id] = child
+            self.cid_map[cid] = dev_id
+        return child
+
+    async def read_frame(self):
+        prefix = await self.reader.readexactly(4)
+        # Dò lại đầu bản tin nếu stream bị lệch
+        while prefix not in (tinytuya.PREFIX_55AA_BIN, tinytuya.PREFIX_6699_BIN):
+            prefix = prefix[1:] + await self.reader.readexactly(1)
+        header_len = HEADER_LEN_6699 if prefix == tinytuya.PREFIX_6699_BIN else HEADER_LEN_55AA
+        data = prefix + await self.reader.readexactly(header_len - 4)
+        header = tinytuya.parse_header(data)
+        data += await self.reader.readexactly(header.total_length - len(data))
+        hmac_key = self.codec.local_key if self.codec.version >= 3.4 else None
+        return tinytuya.unpack_message(data, header=header, hmac_key=hmac_key)
+
+    async def send_payload(self, payload):
+        data = self.codec._encode_message(payload)
+        self.writer.write(data)
+        await self.writer.drain()
+        return tinytuya.parse_header(data)
+
+    async def negotiate_session_key(self):
+        codec = self.codec
+        await self.send_payload(codec._negotiate_session_key_generate_step_1())
+        rkey = None
+        for _ in range(2):
+            rkey = await asyncio.wait_for(self.read_frame(), self.timeout)
+            if rkey and len(rkey.payload) != 0: break
+        step3 = codec._negotiate_session_key_generate_step_3(rkey)
+        if not step3:
+            raise ConnectionError("Session key negotiation failed")
+        await self.send_payload(step3)
+        codec._negotiate_session_key_generate_finalize()
+
+    async def connect(self):
+        self.codec.local_key = self.codec.real_local_key
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port), self.timeout)
+        try:
+            if self.codec.version >= 3.4:
+                await self.negotiate_session_key()
+        except Exception:
+            self.close()
+            raise
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                msg = await self.read_frame()
+                self.last_rx = time.time()
+                self.dispatch(msg)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug(f"Connection {self.ip} closed: {e}")
+        finally:
+            self.fail_waiter(ConnectionError("Connection closed"))
+            self.close()
+
+    def dispatch(self, msg):
+        result = None
+        if msg.payload:
+            try: result = self.codec._decode_payload(msg.payload)
+            except Exception as e: logger.debug(f"Decode error from {self.ip}: {e}")
+
+        w = self.waiter
+        if w and not w.future.done() and msg.cmd in w.cmds and (result is not None or not w.need_payload) \
+                and (not w.cid or not result or self.result_cid(result) in (None, w.cid)):
+            self.waiter = None
+            w.future.set_result(result)
+            return
+
+        if result and 'Error' not in result and self.on_push:
+            self.on_push(self.resolve_dev_id(result), result)
+
+    def result_cid(self, result):
+        cid = result.get('cid')
+        if not cid and isinstance(result.get('data'), dict):
+            cid = result['data'].get('cid')
+        return cid
+
+    def resolve_dev_id(self, result):
+        return self.cid_map.get(self.result_cid(result), self.codec.id)
+
+    def fail_waiter(self, exc):
+        w = self.waiter
+        self.waiter = None
+        if w and not w.future.done():
+            w.future.set_exception(exc)
+
+    async def request(self, payload, cmds=(), need_payload=True, cid=None):
+        """Gửi 1 lệnh và chờ bản tin phản hồi tương ứng (tuần tự trên socket này)."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.connected:
+                await self.connect()
+            future = asyncio.get_running_loop().create_future()
+            enc = self.codec._encode_message(payload)
+            sent = tinytuya.parse_header(enc)
+            self.waiter = Waiter(set(cmds) | {sent.cmd}, need_payload, cid, future)
+            try:
+                self.writer.write(enc)
+                await self.writer.drain()
+                self.last_tx = time.time()
+                return await asyncio.wait_for(future, self.timeout)
+            except Exception:
+                # Socket có thể đã hỏng -> đóng để lần sau kết nối lại
+                self.waiter = None
+                self.close()
+                raise
+
+    def close(self):
+        try: current = asyncio.current_task()
+        except RuntimeError: current = None
+        if self.read_task and self.read_task is not current:
+            self.read_task.cancel()
+        self.read_task = None
+        if self.writer:
+            try: self.writer.close()
+            except: pass
+        self.reader = self.writer = None
+
+
+class AsyncTuyaClient:
+    """
+    Client Tuya LAN chạy trên 1 event loop riêng (luồng nền).
+
+    Mỗi IP dùng 1 kết nối; thiết bị Zigbee con dùng chung kết nối của Gateway.
+    Hàm async_* dùng bên trong event loop, các hàm cùng tên không có tiền tố là
+    bản đồng bộ cho code Flask/MCP hiện tại. Thiết bị mà lớp asyncio không nói
+    được giao thức (3.1, device22...) sẽ đi qua object tinytuya cũ (fallback).
+    """
+
+    def __init__(self, timeout=2.0):
+        self.timeout = timeout
+        self.loop = None
+        self.thread = None
+        self.connections = {}   # (ip, port) -> AsyncTuyaConnection
+        self.devices = {}       # dev_id -> {"conn", "cid", "fallback", "native"}
+        self.on_push = None     # callback(dev_id, data) cho bản tin tự đẩy
+        self.on_link = None     # callback(dev_ids, online) khi socket giữ kết nối lên/xuống
+        self.heartbeat_interval = 10
+        self.guard = threading.Lock()
+
+    def start(self):
+        with self.guard:
+            if self.loop: return self
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='tuya-async')
+            self.thread.start()
+        logger.info("Async Tuya client started")
+        return self
+
+    def handle_push(self, dev_id, data):
+        if self.on_push:
+            try: self.on_push(dev_id, data)
+            except Exception as e: logger.error(f"Push handler error {dev_id}: {e}")
+
+    def register(self, dev_id, ip, key, version=3.3, cid=None, gateway_id=None, fallback=None, port=tinytuya.TCPPORT):
+        """
+        Khai báo thiết bị. Gọi lại khi IP/key/version đổi.
+        Args:
+            cid: node_id của thiết bị con Zigbee (None nếu là thiết bị WiFi).
+            gateway_id: ID Gateway sở hữu socket (bắt buộc với thiết bị con).
+            fallback: object tinytuya dùng khi asyncio không xử lý được.
+        """
+        version = float(version or 3.3)
+        owner_id = gateway_id if cid else dev_id
+        conn_key = (ip, port)
+        with self.guard:
+            old_key = (self.devices.get(dev_id) or {}).get('conn')
+            conn = self.connections.get(conn_key)
+            if conn and (conn.key != key or conn.codec.version != version or conn.port != port or conn.codec.id != owner_id):
+                self.call_soon(conn.close)
+                conn = None
+            if conn is None:
+                conn = AsyncTuyaConnection(owner_id, ip, key, version, port=port, timeout=self.timeout, on_push=self.handle_push)
+                self.connections[conn_key] = conn
+            conn.codec_for(dev_id, cid)
+            self.devices[dev_id] = {"conn": conn_key, "cid": cid, "fallback": fallback, "native": version >= 3.2}
+            # Đổi IP/port -> kết nối cũ có thể không còn ai dùng
+            if old_key and old_key != conn_key: self._drop_unused(old_key)
+
+    def _drop_unused(self, conn_key):
+        """Đóng + bỏ kết nối không còn thiết bị nào dùng (monitor không kết nối lại IP cũ nữa). Gọi trong guard."""
+        if any(v['conn'] == conn_key for v in self.devices.values()): return
+        conn = self.connections.pop(conn_key, None)
+        if conn: self.call_soon(conn.close)
+
+    def start_monitor(self, heartbeat_interval=10):
+        """
+        Chế độ push: giữ mọi socket luôn mở để nhận bản tin thiết bị tự đẩy lên.
+        Socket im lặng quá heartbeat_interval thì gửi HEART_BEAT (rẻ hơn DP_QUERY)
+        để kiểm tra còn sống; socket rớt thì kết nối lại với backoff.
+        """
+        self.start()
+        self.heartbeat_interval = heartbeat_interval
+        asyncio.run_coroutine_threadsafe(self.monitor(), self.loop)
+        logger.info(f"Push monitor started (heartbeat {heartbeat_interval}s)")
+
+    async def monitor(self):
+        while True:
+            conns = list(self.connections.items())
+            await asyncio.gather(*[self.keep_alive(key, conn) for key, conn in conns], return_exceptions=True)
+            await asyncio.sleep(1)
+
+    async def keep_alive(self, key, conn):
+        now = time.time()
+        if self.connections.get(key) is not conn: return   # Đã bị bỏ (đổi IP / bỏ thiết bị)
+        if not conn.connected:
+            if now < conn.retry_at: return
+            try:
+                if conn.lock is None: conn.lock = asyncio.Lock()
+                async with conn.lock:
+                    if not conn.connected: await conn.connect()
+                if self.connections.get(key) is not conn:
+                    conn.close()   # Bị bỏ trong lúc đang kết nối
+                    return
+                conn.backoff = 0
+                self.notify_link(key, conn, True)
+            except Exception:
+                conn.backoff = min(RECONNECT_BACKOFF_MAX, conn.backoff * 2 if conn.backoff else RECONNECT_BACKOFF_START)
+                conn.retry_at = now + conn.backoff
+                self.notify_link(key, conn, False)
+            return
+
+        if now - max(conn.last_rx, conn.last_tx) >= self.heartbeat_interval:
+            try:
+                await conn.request(conn.codec.generate_payload(tinytuya.HEART_BEAT), need_payload=False)
+            except Exception:
+                self.notify_link(key, conn, False)
+
+    def notify_link(self, key, conn, online):
+        if conn.link_up == online: return
+        conn.link_up = online
+        if not self.on_link: return
+        dev_ids = [d for d, v in list(self.devices.items()) if v['conn'] == key]
+        try: self.on_link(dev_ids, online)
+        except Exception as e: logger.error(f"Link handler error {key}: {e}")
+
+    def unregister(self, dev_id):
+        with self.guard:
+            dev = self.devices.pop(dev_id, None)
+            if dev: self._drop_unused(dev['conn'])
+
+    def call_soon(self, func, *args):
+        if self.loop: self.loop.call_soon_threadsafe(func, *args)
+        else: func(*args)
+
+    def run(self, coro, timeout=None):
+        """Chạy coroutine trên loop nền và chờ kết quả (dùng từ luồng thường)."""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    # --- ASYNC API ---
+    async def call(self, dev_id, command, data=None, cmds=(), need_payload=True, fallback_name=None, fallback_args=()):
+        dev = self.devices.get(dev_id)
+        if not dev:
+            return tinytuya.error_json(tinytuya.ERR_PARAMS, f"Unknown device {dev_id}")
+
+        if not dev['native'] and dev['fallback'] is not None and fallback_name:
+            func = getattr(dev['fallback'], fallback_name)
+            return await asyncio.get_running_loop().run_in_executor(None, func, *fallback_args)
+
+        conn = self.connections[dev['conn']]
+        codec = conn.codec_for(dev_id, dev['cid'])
+        try:
+            payload = codec.generate_payload(command, data)
+            return await conn.request(payload, cmds, need_payload, dev['cid'])
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            return tinytuya.error_json(tinytuya.ERR_OFFLINE)
+        except Exception as e:
+            logger.debug(f"Async call failed {dev_id}: {e}")
+            if dev['fallback'] is not None and fallback_name:
+                func = getattr(dev['fallback'], fallback_name)
+                return await asyncio.get_running_loop().run_in_executor(None, func, *fallback_args)
+            return tinytuya.error_json(tinytuya.ERR_PAYLOAD, str(e))
+
+    async def async_status(self, dev_id):
+        return await self.call(dev_id, tinytuya.DP_QUERY, cmds=(tinytuya.STATUS,), fallback_name='status')
+
+    async def async_set_value(self, dev_id, dp_id, value):
+        return await self.call(dev_id, tinytuya.CONTROL, {str(dp_id): value}, need_payload=False,
+                               fallback_name='set_value', fallback_args=(str(dp_id), value))
+
+    async def async_set_multiple_values(self, dev_id, dps):
+        dps = {str(k): v for k, v in dps.items()}
+        return await self.call(dev_id, tinytuya.CONTROL, dps, need_payload=False,
+                               fallback_name='set_multiple_values', fallback_args=(dps,))
+
+    async def async_heartbeat(self, dev_id):
+        return await self.call(dev_id, tinytuya.HEART_BEAT, need_payload=False,
+                               fallback_name='heartbeat', fallback_args=(False,))
+
+    async def async_status_many(self, dev_ids):
+        results = await asyncio.gather(*[self.async_status(d) for d in dev_ids], return_exceptions=True)
+        return {d: (r if not isinstance(r, BaseException) else tinytuya.error_json(tinytuya.ERR_CONNECT, str(r)))
+                for d, r in zip(dev_ids, results)}
+
+    async def async_close(self):
+        for conn in list(self.connections.values()):
+            conn.close()
+
+    # --- SYNC API ---
+    def status(self, dev_id):
+        return self.run(self.async_status(dev_id))
+
+    def set_value(self, dev_id, dp_id, value):
+        return self.run(self.async_set_value(dev_id, dp_id, value))
+
+    def set_multiple_values(self, dev_id, dps):
+        return self.run(self.async_set_multiple_values(dev_id, dps))
+
+    def heartbeat(self, dev_id):
+        return self.run(self.async_heartbeat(dev_id))
+
+    def status_many(self, dev_ids):
+        return self.run(self.async_status_many(list(dev_ids)))
+
+    def close(self):
+        if self.loop:
+            self.run(self.async_close())
@@ -0,0 +1,16 @@
+# FILE: tuya_dps.py
+import re
+
+# Code DP công tắc chính: switch, switch_1..n, switch_led (không gồm switch_backlight, child_lock...)
+SWITCH_CODE = re.compile(r'^switch(_\d+|_led)?$')
+
+def switch_dps(mapping, dps=None, is_light=False):
+    """
+    Các DP cần gửi khi Bật/Tắt cả thiết bị (không chỉ định DP).
+    - Có mapping: mọi DP Boolean có code công tắc (công tắc 3 nút -> ['1', '2', '3']).
+    - Không có: '20' cho đèn (nếu thiết bị có DP 20), còn lại '1' (giống turn_on/turn_off của tinytuya).
+    """
+    keys = [str(k) for k, d in (mapping or {}).items()
+            if isinstance(d, dict) and d.get('type') == 'Boolean' and SWITCH_CODE.match(str(d.get('code', '')))]
+    if keys: return sorted(keys, key=lambda k: (len(k), k))
+    return ['20'] if is_light and '20' in (dps or {}) else ['1']
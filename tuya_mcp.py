@@ -2,8 +2,14 @@
 import tinytuya
 import json
 import os
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import db_manager # <--- MỚI
+from name_resolver import NameResolver
+from device_pool import DevicePool
+from tuya_dps import switch_dps
 
 # Setup Logger riêng
 logger = logging.getLogger('tuya_module')
@@ -11,10 +17,30 @@ logger = logging.getLogger('tuya_module')
 # Global variables
 tuya_cache = {} 
 device_lookup = {} 
+resolver = NameResolver([])  # Chỉ mục tìm theo tên (không dấu, gần đúng), dựng lại cùng device_lookup
+loaded_version = None   # devices_version lúc dựng chỉ mục (None = chưa nạp)
+# Kết nối giữ sẵn cho control/status khi chạy riêng (không có web_backend): lệnh lặp lại không phải connect + bắt tay lại
+pool = DevicePool(max_open=8, idle_timeout=30)
+# Lệnh nhiều thiết bị: mỗi kết nối (Gateway/thiết bị WiFi) 1 luồng, tối đa = số socket của pool
+control_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='mcp-control')
+# check_status trả lời từ trạng thái đã biết nếu mới hơn max_age giây (settings key: mcp_status_max_age)
+STATUS_MAX_AGE = 30
+# Chạy chung với Web (master_mcp): đọc/ghi qua poller của main (chung socket + làn IP) thay vì pool,
+# vì nhiều thiết bị Tuya chỉ nhận 1 kết nối LAN. None = chạy riêng, dùng pool.
+web_backend = None
 
-def load_devices():
-    """Nạp và xử lý danh sách thiết bị từ SQLite"""
-    global tuya_cache, device_lookup
+def load_devices(force=False):
+    """
+    Nạp và xử lý danh sách thiết bị từ SQLite.
+    Chỉ dựng lại chỉ mục khi cấu hình thiết bị đổi (bộ đếm meta.devices_version),
+    nên gọi ở đầu mỗi lệnh giọng nói chỉ tốn 1 câu query nhỏ.
+    """
+    global tuya_cache, device_lookup, resolver, loaded_version
+
+    # Đọc version trước khi đọc dữ liệu: có ghi xen giữa thì lần sau nạp lại
+    version = db_manager.get_devices_version()
+    if not force and version is not None and version == loaded_version:
+        return
     
     try:
         # 1. Lấy dữ liệu từ DB
@@ -63,12 +89,27 @@ def load_devices():
 
         tuya_cache = temp_cache
         device_lookup = temp_lookup
+        resolver = NameResolver(temp_lookup.values())
+        loaded_version = version
         logger.info(f"Loaded {len(tuya_cache)} devices from DB.")
 
     except Exception as e:
         logger.error(f"Error loading devices: {e}")
 
+def find_device(device_name):
+    """Tìm theo tên gọi -> (target_info, candidates). Xem NameResolver.resolve."""
+    load_devices()
+    return resolver.resolve(device_name)
+
+def ambiguous_message(device_name, candidates):
+    """Câu hỏi lại khi tên khớp nhiều thiết bị hoặc chỉ khớp gần đúng (None nếu không mơ hồ)."""
+    if not candidates: return None
+    if len(candidates) == 1:
+        return f"Không tìm thấy '{device_name}'. Có phải bạn muốn nói '{candidates[0]['name']}'?"
+    return f"Có nhiều thiết bị khớp '{device_name}': {', '.join(c['name'] for c in candidates)}. Bạn muốn chọn thiết bị nào?"
+
 def get_tuya_obj(dev_info):
+    """Object kết nối 1 lần (không giữ socket). Các tool dùng pool.session(); hàm này để so sánh/đo."""
     try:
         dev_id = dev_info['id']
         ip = dev_info.get('ip')
@@ -77,7 +118,7 @@ def get_tuya_obj(dev_info):
         
         if not ip: return None, "Missing IP"
 
-        d = tinytuya.OutletDevice(dev_id, ip, key)
+        d = tinytuya.OutletDevice(dev_id, ip, key, port=dev_info.get('port', tinytuya.TCPPORT))
         if dev_info.get('is_sub'):
             d.cid = dev_info.get('node_id', dev_id)
         
@@ -89,6 +130,29 @@ def get_tuya_obj(dev_info):
     except Exception as e:
         return None, str(e)
 
+def parse_command(command):
+    cmd = command.lower().strip()
+    return (cmd == 'on' or cmd == 'bật' or cmd == 'true' or cmd == '1' or 'bật' in cmd)
+
+def switch_target(target_info, dev_config, is_on):
+    """
+    Gửi lệnh Bật/Tắt qua web_backend hoặc kết nối trong pool. Không chỉ định DP -> mọi DP công tắc của thiết bị
+    trong 1 frame. Lỗi (kể cả lỗi tinytuya trả về dạng dict) -> raise.
+    """
+    dp_id = target_info['dp']
+    dp_ids = [str(dp_id)] if dp_id else switch_dps(dev_config.get('mapping'))
+    dps = {k: is_on for k in dp_ids}
+    if web_backend:
+        # Cache + DB + lịch sử do main cập nhật
+        web_backend.write_device(target_info['id'], dps)
+        return
+    with pool.session(dev_config) as d:
+        result = d.set_multiple_values(dps)
+    if isinstance(result, dict) and result.get('Error'):
+        raise RuntimeError(result['Error'])
+    # Update DB (Optional nhưng nên làm để đồng bộ với Web)
+    db_manager.update_device_state(target_info['id'], dps)
+
 # --- CÁC HÀM CÔNG CỤ (TOOLS) ---
 # Lưu ý: Không dùng @mcp.tool() ở đây, ta chỉ định nghĩa hàm thuần Python.
 
@@ -104,69 +168,121 @@ def list_devices() -> str:
 
 def control_device(device_name: str, command: str) -> str:
     """Bật/Tắt thiết bị điện."""
-    load_devices()
-    target_name = device_name.lower().strip()
-    target_info = None
-
-    if target_name in device_lookup:
-        target_info = device_lookup[target_name]
-    else:
-        for key, info in device_lookup.items():
-            if target_name in key:
-                target_info = info; break
-    
-    if not target_info: return f"Không tìm thấy '{device_name}'."
+    target_info, candidates = find_device(device_name)
+    if not target_info: return ambiguous_message(device_name, candidates) or f"Không tìm thấy '{device_name}'."
 
     dev_config = tuya_cache.get(target_info['id'])
-    d, err = get_tuya_obj(dev_config)
-    if err: return f"Lỗi kết nối: {err}"
+    if not dev_config.get('ip'): return "Lỗi kết nối: Missing IP"
 
-    cmd = command.lower().strip()
-    is_on = (cmd == 'on' or cmd == 'bật' or cmd == 'true' or cmd == '1' or 'bật' in cmd)
-    dp_id = target_info['dp']
+    is_on = parse_command(command)
     real_name = target_info['name']
 
     try:
-        if dp_id:
-            d.set_value(str(dp_id), is_on)
-            # Update DB (Optional nhưng nên làm để đồng bộ với Web)
-            db_manager.update_device_state(target_info['id'], {str(dp_id): is_on})
-            return f"Đã {command} {real_name}."
-        else:
-            if is_on: d.turn_on()
-            else: d.turn_off()
-            # Update DB
-            # Note: Thiết bị đơn thường trả về dps '1' hoặc '20'
-            # Ở đây ta set tạm giả định, thực tế nên chờ polling cập nhật
-            return f"Đã {command} toàn bộ {real_name}."
+        switch_target(target_info, dev_config, is_on)
+        if target_info['dp']: return f"Đã {command} {real_name}."
+        return f"Đã {command} toàn bộ {real_name}."
     except Exception as e: return f"Thất bại: {e}"
 
-def check_status(device_name: str) -> str:
-    """Kiểm tra trạng thái thiết bị."""
+def control_devices(device_names: list[str], command: str) -> str:
+    """
+    Bật/Tắt nhiều thiết bị trong 1 lệnh (VD: "tắt hết đèn tầng 1").
+    Tìm tên 1 lượt, gom lệnh theo kết nối vật lý (1 Gateway / 1 thiết bị WiFi):
+    các nhóm chạy song song, trong nhóm chạy lần lượt trên cùng socket.
+    """
     load_devices()
-    target_name = device_name.lower().strip()
-    target_info = None
-    
-    if target_name in device_lookup: target_info = device_lookup[target_name]
-    else:
-        for key, info in device_lookup.items():
-            if target_name in key: target_info = info; break
-    
-    if not target_info: return "Không tìm thấy thiết bị."
+    is_on = parse_command(command)
+    lines = [None] * len(device_names)
+    groups = {}
+    seen = set()
+    done = []
+    for i, name in enumerate(device_names):
+        target_info, candidates = resolver.resolve(name)
+        if not target_info:
+            lines[i] = f"- {name}: " + (ambiguous_message(name, candidates) or "không tìm thấy.")
+            continue
+        target = (target_info['id'], target_info['dp'])
+        if target in seen:
+            lines[i] = f"- {target_info['name']}: trùng, bỏ qua."
+            continue
+        seen.add(target)
+        dev_config = tuya_cache.get(target_info['id'])
+        if not dev_config.get('ip'):
+            lines[i] = f"- {target_info['name']}: lỗi kết nối (Missing IP)."
+            continue
+        groups.setdefault(pool.conn_key(dev_config), []).append((i, target_info, dev_config))
+
+    def run_group(items):
+        for i, target_info, dev_config in items:
+            try:
+                switch_target(target_info, dev_config, is_on)
+                lines[i] = f"- {target_info['name']}: đã {command}."
+                done.append(i)
+            except Exception as e:
+                lines[i] = f"- {target_info['name']}: thất bại ({e})."
+
+    for f in [control_executor.submit(run_group, items) for items in groups.values()]:
+        f.result()
+
+    return f"Đã {command} {len(done)}/{len(device_names)} thiết bị:\n" + "\n".join(lines)
+
+def set_web_backend(backend):
+    """
+    backend (VD: module main) cần có:
+    get_cached_state(dev_id) -> {'dps', 'online', 'last_update'} | None,
+    read_device(dev_id) -> data có 'dps' | None, write_device(dev_id, dps).
+    """
+    global web_backend
+    web_backend = backend
+
+def cached_state(dev_id, max_age):
+    """
+    dps đã biết nếu được cập nhật trong vòng max_age giây, None nếu phải đọc trực tiếp.
+    Lấy bản mới nhất giữa Cache của poller và DB (DB có cả lệnh điều khiển từ MCP chưa được poll).
+    """
+    sources = [db_manager.get_device(dev_id)]
+    if web_backend:
+        try: sources.append(web_backend.get_cached_state(dev_id))
+        except Exception as e: logger.error(f"State provider error: {e}")
+    sources = sorted((s for s in sources if s), key=lambda s: s.get('last_update') or 0)
+    if not sources: return None
+    newest = sources[-1]
+    if not newest.get('online') or not newest.get('dps'): return None
+    if time.time() - (newest.get('last_update') or 0) > max_age: return None
+    dps = {}
+    for s in sources: dps.update(s.get('dps') or {})
+    return dps
+
+def read_status(dev_id, dev_config, max_age):
+    """dps từ trạng thái đủ mới, hoặc đọc thiết bị (qua web_backend / pool) rồi ghi ngược lại DB. None = Offline."""
+    dps = cached_state(dev_id, max_age) if max_age > 0 else None
+    if dps is not None: return dps
+    if web_backend:
+        # Poller tự cập nhật Cache + DB
+        data = web_backend.read_device(dev_id)
+        return data['dps'] if data and 'dps' in data else None
+    with pool.session(dev_config) as d:
+        data = d.status()
+    if not data or 'dps' not in data: return None
+    db_manager.update_device_state(dev_id, data['dps'])
+    return data['dps']
+
+def check_status(device_name: str, max_age: Optional[float] = None) -> str:
+    """
+    Kiểm tra trạng thái thiết bị.
+    Args:
+        device_name: Tên thiết bị hoặc tên nút.
+        max_age: Chấp nhận trạng thái cũ tối đa bao nhiêu giây (bỏ trống = mặc định, 0 = đọc trực tiếp từ thiết bị).
+    """
+    target_info, candidates = find_device(device_name)
+    if not target_info: return ambiguous_message(device_name, candidates) or "Không tìm thấy thiết bị."
 
     dev_config = tuya_cache.get(target_info['id'])
-    # Ưu tiên lấy từ Cache DB nếu có (để phản hồi nhanh và tránh connect nhiều)
-    # Tuy nhiên tool này yêu cầu check thực tế nên ta vẫn kết nối
-    d, err = get_tuya_obj(dev_config)
-    if err: return "Mất kết nối."
+    if not dev_config.get('ip'): return "Mất kết nối."
+    if max_age is None: max_age = db_manager.get_setting('mcp_status_max_age', STATUS_MAX_AGE, float)
 
     try:
-        data = d.status()
-        if not data or 'dps' not in data: return "Thiết bị Offline."
-        dps = data['dps']
-        
-        # Update ngược lại DB
-        db_manager.update_device_state(target_info['id'], dps)
+        dps = read_status(target_info['id'], dev_config, max_age)
+        if dps is None: return "Thiết bị Offline."
         
         if target_info['dp']:
             st = "BẬT" if dps.get(str(target_info['dp'])) else "TẮT"
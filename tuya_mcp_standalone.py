@@ -4,6 +4,8 @@ import json
 import os
 import time
 import logging
+from name_resolver import NameResolver
+from tuya_dps import switch_dps
 
 # --- LOGGING SETUP ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,13 +18,20 @@ DEVICES_FILE = 'devices.json'
 # Cache
 tuya_cache = {} 
 device_lookup = {} 
+resolver = NameResolver([])  # Chỉ mục tìm theo tên (không dấu, gần đúng)
+loaded_stamp = None     # (mtime_ns, size) của devices.json lúc dựng chỉ mục
 
-def load_devices():
-    """Nạp thiết bị và tạo chỉ mục tìm kiếm thông minh."""
-    global tuya_cache, device_lookup
-    if not os.path.exists(DEVICES_FILE):
+def load_devices(force=False):
+    """Nạp thiết bị và tạo chỉ mục tìm kiếm thông minh (chỉ khi devices.json thay đổi)."""
+    global tuya_cache, device_lookup, resolver, loaded_stamp
+    try:
+        st = os.stat(DEVICES_FILE)
+    except OSError:
         logger.error("File devices.json not found")
         return
+    stamp = (st.st_mtime_ns, st.st_size)
+    if not force and stamp == loaded_stamp:
+        return
 
     try:
         with open(DEVICES_FILE, 'r', encoding='utf-8') as f:
@@ -74,6 +83,8 @@ def load_devices():
 
         tuya_cache = temp_cache
         device_lookup = temp_lookup
+        resolver = NameResolver(temp_lookup.values())
+        loaded_stamp = stamp
         logger.info(f"Loaded {len(tuya_cache)} devices, {len(device_lookup)} searchable names.")
 
     except Exception as e:
@@ -81,6 +92,17 @@ def load_devices():
 
 load_devices()
 
+def find_device(device_name):
+    """Tìm theo tên gọi -> (target_info, candidates). Xem NameResolver.resolve."""
+    load_devices()
+    return resolver.resolve(device_name)
+
+def ambiguous_message(device_name, candidates):
+    if not candidates: return None
+    if len(candidates) == 1:
+        return f"Không tìm thấy '{device_name}'. Có phải bạn muốn nói '{candidates[0]['name']}'?"
+    return f"Có nhiều thiết bị khớp '{device_name}': {', '.join(c['name'] for c in candidates)}. Bạn muốn chọn thiết bị nào?"
+
 def get_device_obj(dev_info):
     try:
         dev_id = dev_info['id']
@@ -123,20 +145,9 @@ def control_device(device_name: str, command: str) -> str:
         device_name: Tên thiết bị hoặc tên nút (VD: 'Hút mùi', 'Đèn trần').
         command: 'on' hoặc 'off'.
     """
-    load_devices()
-    target_name = device_name.lower().strip()
-    target_info = None
-
-    if target_name in device_lookup:
-        target_info = device_lookup[target_name]
-    else:
-        for key, info in device_lookup.items():
-            if target_name in key:
-                target_info = info
-                break
-    
+    target_info, candidates = find_device(device_name)
     if not target_info:
-        return f"Không tìm thấy thiết bị '{device_name}'."
+        return ambiguous_message(device_name, candidates) or f"Không tìm thấy thiết bị '{device_name}'."
 
     dev_config = tuya_cache.get(target_info['id'])
     if not dev_config: return "Lỗi cấu hình thiết bị."
@@ -156,8 +167,8 @@ def control_device(device_name: str, command: str) -> str:
             return f"Đã {cmd} {real_name}."
         else:
             logger.info(f"Control MAIN: {real_name} -> {cmd}")
-            if is_on: d.turn_on()
-            else: d.turn_off()
+            # Mọi DP công tắc (công tắc nhiều nút) trong 1 frame
+            d.set_multiple_values({k: is_on for k in switch_dps(dev_config.get('mapping'))})
             return f"Đã {cmd} toàn bộ {real_name}."
     except Exception as e:
         logger.error(f"Failed: {e}")
@@ -171,21 +182,10 @@ def check_status(device_name: str) -> str:
     Args:
         device_name: Tên thiết bị (VD: 'Công tắc vệ sinh') hoặc tên nút (VD: 'Hút mùi').
     """
-    load_devices()
-    target_name = device_name.lower().strip()
-    target_info = None
-
-    # Tìm kiếm (Chính xác hoặc Gần đúng)
-    if target_name in device_lookup:
-        target_info = device_lookup[target_name]
-    else:
-        for key, info in device_lookup.items():
-            if target_name in key:
-                target_info = info
-                break
-    
+    # Tìm kiếm (không dấu, gần đúng; nhiều kết quả ngang nhau thì hỏi lại)
+    target_info, candidates = find_device(device_name)
     if not target_info:
-        return f"Không tìm thấy thiết bị '{device_name}' để kiểm tra."
+        return ambiguous_message(device_name, candidates) or f"Không tìm thấy thiết bị '{device_name}' để kiểm tra."
 
     dev_config = tuya_cache.get(target_info['id'])
     d, err = get_device_obj(dev_config)